@@ -0,0 +1,87 @@
+import math
+import threading
+import time
+from collections import deque
+
+
+class Overloaded(Exception):
+    """The request was shed; `retry_after` is a hint in whole seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Overloaded ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Caps how many requests run at once. Up to `max_in_flight` run, up to
+    `max_queue` more wait in arrival order for at most `max_wait` seconds,
+    and anything beyond that is shed straight away. Shedding early keeps
+    latency stable for the requests already admitted.
+    A `max_in_flight` of 0 admits everything.
+    """
+
+    def __init__(self, max_in_flight=0, max_queue=0, max_wait=0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        self._in_flight = 0
+        self._waiters = deque()
+        self._condition = threading.Condition()
+        self._service_time = None  # moving average of admitted request durations
+        self._counters = {'admitted': 0, 'shed_queue_full': 0, 'shed_timeout': 0}
+
+    def acquire(self):
+        """
+        Blocks until the request may run and returns its admission time, for `release`.
+        Raises Overloaded if the queue is full or the wait budget runs out.
+        """
+        if not self.max_in_flight:
+            return time.monotonic()
+        with self._condition:
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                return self._admit()
+            if len(self._waiters) >= self.max_queue:
+                self._counters['shed_queue_full'] += 1
+                raise Overloaded('queue full', self._retry_after())
+
+            ticket = object()
+            self._waiters.append(ticket)
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while self._waiters[0] is not ticket or self._in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['shed_timeout'] += 1
+                        raise Overloaded('queue timeout', self._retry_after())
+                    self._condition.wait(remaining)
+                return self._admit()
+            finally:
+                self._waiters.remove(ticket)
+                self._condition.notify_all()
+
+    def _admit(self):
+        self._in_flight += 1
+        self._counters['admitted'] += 1
+        return time.monotonic()
+
+    def release(self, admitted_at):
+        if not self.max_in_flight:
+            return
+        elapsed = time.monotonic() - admitted_at
+        with self._condition:
+            self._in_flight -= 1
+            self._service_time = elapsed if self._service_time is None else 0.9 * self._service_time + 0.1 * elapsed
+            self._condition.notify_all()
+
+    def _retry_after(self):
+        """Seconds until the current queue has likely drained."""
+        if self._service_time is None:
+            return max(1, math.ceil(self.max_wait))
+        return max(1, math.ceil(self._service_time * (len(self._waiters) + 1) / self.max_in_flight))
+
+    def stats(self):
+        with self._condition:
+            return dict(self._counters, in_flight=self._in_flight, queued=len(self._waiters))
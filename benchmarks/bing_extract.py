@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the Bing results extractor against the BeautifulSoup parse it replaced.
+
+Both run on the same stub results page (benchmarks/stubs.py). The streaming
+extractor is fed --chunk-kb chunks, as it is from iter_content, and stops at
+--max-images; the BeautifulSoup baseline parses the whole decoded page, as
+the old `_search_bing_images` did.
+
+    python benchmarks/bing_extract.py --page-kb 300 --max-images 6 --rounds 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bing import extract_image_urls  # noqa: E402
+from stubs import StubConfig, bing_page  # noqa: E402
+
+
+def soup_image_urls(text, max_images):
+    """The previous implementation: parse everything, then read the first `.iusc` anchors."""
+    soup = BeautifulSoup(text, 'html.parser')
+    image_urls = []
+    for element in soup.select('.iusc')[:max_images]:
+        if 'data-src' in element.attrs:
+            image_urls.append(element['data-src'])
+        elif 'm' in element.attrs:
+            try:
+                data = json.loads(element['m'])
+                if 'murl' in data:
+                    image_urls.append(data['murl'])
+            except ValueError:
+                pass
+    return image_urls
+
+
+def chunked(payload, size):
+    """Yields `payload` in `size` byte pieces and counts how many bytes were consumed."""
+    chunked.consumed = 0
+    for start in range(0, len(payload), size):
+        chunk = payload[start:start + size]
+        chunked.consumed += len(chunk)
+        yield chunk
+
+
+def best_of(rounds, fn):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), sorted(timings)[len(timings) // 2], result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page-kb', type=int, default=300, help='Size of the generated results page')
+    parser.add_argument('--images-per-page', type=int, default=12)
+    parser.add_argument('--max-images', type=int, default=6)
+    parser.add_argument('--chunk-kb', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    config = StubConfig(bing_page_kb=args.page_kb, images_per_page=args.images_per_page)
+    payload = bing_page(config, 'Indian Peafowl bird').encode()
+    chunk_size = args.chunk_kb * 1024
+
+    soup_best, soup_median, soup_urls = best_of(
+        args.rounds, lambda: soup_image_urls(payload.decode(), args.max_images)
+    )
+    stream_best, stream_median, stream_urls = best_of(
+        args.rounds, lambda: extract_image_urls(chunked(payload, chunk_size), args.max_images)
+    )
+    if soup_urls != stream_urls:
+        print(f"Results differ:\n  soup:   {soup_urls}\n  stream: {stream_urls}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Page {len(payload) // 1024} KiB, {len(stream_urls)} URLs")
+    print(f"beautifulsoup  best={soup_best * 1000:8.2f}ms median={soup_median * 1000:8.2f}ms read={len(payload)}B")
+    print(f"streaming      best={stream_best * 1000:8.2f}ms median={stream_median * 1000:8.2f}ms "
+          f"read={chunked.consumed}B")
+    print(f"speedup        {soup_median / stream_median:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+Accuracy and query latency of the local first-tier classifier (classifier.py).
+
+The evaluation learns half the photos of each known species into a fresh index
+through the normal `learn` path and classifies the other half, plus every photo
+of --unknown species the index never saw, at each --min-similarity. It reports
+how many known photos get an answer, how many answers are right and how many
+unknown photos get a (necessarily wrong) answer, then the similarity of
+nearest neighbours of the same and of other species, and of re-encoded copies
+and separate shots of the same scene, which the `learn` duplicate check must
+tell apart. Photos come from --photos, laid out like `flask learn-images`
+expects, or are synthetic birds of lookalike colours on shared backgrounds.
+
+The latency part fills an index file with --entries synthetic feature vectors
+and reports the add rate, the file size, the load time in a fresh process and
+the latency of exact k-nearest-neighbour queries, with numpy and in pure Python.
+
+    python benchmarks/classifier_index.py --per-species 16 --entries 100000
+    python benchmarks/classifier_index.py --photos labelled/ --entries 0
+"""
+import argparse
+import io
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from classifier import FeatureIndex, NearestNeighbourClassifier, _numpy  # noqa: E402
+from imaging import FEATURE_DIM, image_features  # noqa: E402
+
+# Body, head and wing colours; the pairs of dark, white and grey birds are deliberate lookalikes
+SPECIES_COLOURS = {
+    'House Crow': ((30, 30, 32), (20, 20, 22), (60, 60, 65)),
+    'Black Drongo': ((15, 15, 20), (15, 15, 20), (25, 25, 35)),
+    'Little Egret': ((245, 245, 240), (250, 250, 250), (235, 235, 230)),
+    'Cattle Egret': ((245, 245, 240), (230, 180, 90), (240, 240, 235)),
+    'Rock Pigeon': ((130, 135, 150), (100, 105, 120), (150, 155, 170)),
+    'Red-vented Bulbul': ((90, 80, 70), (20, 20, 20), (110, 100, 90)),
+    'Common Myna': ((110, 70, 40), (20, 20, 20), (240, 240, 240)),
+    'Rose-ringed Parakeet': ((80, 180, 60), (90, 190, 70), (60, 140, 50)),
+    'Common Kingfisher': ((220, 120, 40), (40, 120, 200), (30, 110, 190)),
+    'Indian Peafowl': ((20, 60, 160), (30, 80, 170), (40, 120, 90)),
+    'Eurasian Golden Oriole': ((240, 200, 20), (240, 200, 20), (20, 20, 20)),
+    'Purple Sunbird': ((60, 30, 90), (70, 40, 110), (50, 25, 80)),
+}
+BACKGROUNDS = {
+    'sky': ((110, 160, 220), (180, 210, 240)),
+    'foliage': ((40, 90, 40), (90, 140, 70)),
+    'wall': ((170, 150, 130), (200, 185, 165)),
+}
+
+
+def shade(colour, rng, light):
+    return tuple(max(0, min(255, int(value * light + rng.gauss(0, 6)))) for value in colour)
+
+
+def synthetic_photo(species, rng, background=None, bird=None, size=(640, 480)):
+    """
+    A JPEG of a bird of `species` on a vertical-gradient background, and its placement.
+    Passing back the placement as `bird` gives another shot of the same scene.
+    """
+    width, height = size
+    top, bottom = BACKGROUNDS[background or rng.choice(sorted(BACKGROUNDS))]
+    light = rng.uniform(0.85, 1.15)
+    image = Image.new('RGB', size)
+    draw = ImageDraw.Draw(image)
+    for y in range(height):
+        colour = tuple(int(a + (b - a) * y / height) for a, b in zip(top, bottom))
+        draw.line([(0, y), (width, y)], fill=shade(colour, rng, light))
+    if bird is None:
+        bird = (rng.uniform(0.3, 0.7) * width, rng.uniform(0.35, 0.65) * height, rng.uniform(0.7, 1.3), rng.random() < 0.5)
+    x, y, scale, facing = bird
+    body, head, wing = (shade(colour, rng, light) for colour in SPECIES_COLOURS[species])
+    half_width, half_height = 110 * scale, 60 * scale
+    direction = -1 if facing else 1
+    draw.ellipse([x - half_width, y - half_height, x + half_width, y + half_height], fill=body)
+    head_x = x + direction * half_width * 0.9
+    draw.ellipse([head_x - 38 * scale, y - half_height - 30 * scale, head_x + 38 * scale, y - half_height + 40 * scale], fill=head)
+    draw.ellipse([x - half_width * 0.6, y - half_height * 0.5, x + half_width * 0.3, y + half_height * 0.6], fill=wing)
+    tail = x - direction * half_width * 1.7
+    draw.polygon([(x - direction * half_width * 0.9, y), (tail, y - 25 * scale), (tail, y + 25 * scale)], fill=wing)
+    image = image.filter(ImageFilter.GaussianBlur(rng.uniform(0.5, 1.5)))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=rng.randint(70, 92))
+    return output.getvalue(), bird
+
+
+def synthetic_photos(per_species, seed=0):
+    rng = random.Random(seed)
+    return {species: [synthetic_photo(species, rng)[0] for _ in range(per_species)] for species in SPECIES_COLOURS}
+
+
+def folder_photos(folder):
+    """Photos per species from one subfolder per species, as for `flask learn-images`."""
+    photos = {}
+    for species in sorted(os.listdir(folder)):
+        species_folder = os.path.join(folder, species)
+        if not os.path.isdir(species_folder):
+            continue
+        for filename in sorted(os.listdir(species_folder)):
+            with open(os.path.join(species_folder, filename), 'rb') as f:
+                photos.setdefault(species, []).append(f.read())
+    return photos
+
+
+def reencoded(image_data):
+    """The same photo shrunk and saved again at a lower quality, as a repeat upload would be."""
+    image = Image.open(io.BytesIO(image_data)).convert('RGB')
+    image = image.resize((image.width * 3 // 4, image.height * 3 // 4))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=60)
+    return output.getvalue()
+
+
+def dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+def quantiles(values):
+    if not values:
+        return 'n/a'
+    ordered = sorted(values)
+    pick = lambda pct: ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]  # noqa: E731
+    return f"min={ordered[0]:.3f} p5={pick(5):.3f} p50={pick(50):.3f} p95={pick(95):.3f} max={ordered[-1]:.3f}"
+
+
+def evaluate(photos, args):
+    rng = random.Random(args.seed)
+    species = sorted(photos)
+    rng.shuffle(species)
+    unknown, known = species[:args.unknown], species[args.unknown:]
+
+    started = time.perf_counter()
+    features = {name: [image_features(data) for data in photos[name]] for name in species}
+    count = sum(len(vectors) for vectors in features.values())
+    print(f"Features of {count} photos of {len(species)} species, {(time.perf_counter() - started) / count * 1000:.1f}ms each")
+
+    tier = NearestNeighbourClassifier(FeatureIndex(), k=args.k, min_votes=args.min_votes,
+                                      min_confidence=args.min_confidence)
+    queries = []
+    for name in known:
+        half = len(features[name]) // 2
+        for vector in features[name][:half]:
+            tier.learn(vector, name)
+        queries.extend((vector, name) for vector in features[name][half:])
+    strangers = [(vector, name) for name in unknown for vector in features[name]]
+    stats = tier.stats()
+    print(f"Learned {stats['learned']} photos of {len(known)} species, {stats['duplicates']} wrongly skipped as duplicates; "
+          f"{len(queries)} held-out photos, {len(strangers)} of {len(unknown)} unknown species")
+
+    print(f"k={args.k} min_votes={args.min_votes} min_confidence={args.min_confidence}")
+    for threshold in args.min_similarity:
+        tier.min_similarity = threshold
+        answers = [(tier.classify(vector), name) for vector, name in queries]
+        answered = [(match, name) for match, name in answers if match]
+        correct = sum(match.species == name for match, name in answered)
+        wrong_unknown = sum(tier.classify(vector) is not None for vector, _ in strangers)
+        precision = f"{correct / len(answered):.1%}" if answered else 'n/a'
+        print(f"  min_similarity={threshold:.3f} answered {len(answered)}/{len(queries)} known ({len(answered) / len(queries):.0%}), "
+              f"right {correct}/{len(answered)} ({precision}), answered {wrong_unknown}/{len(strangers)} unknown")
+
+    same, nearest_other = [], []
+    for vector, name in queries + strangers:
+        neighbours = tier.index.search(vector, len(tier.index))
+        same.extend(similarity for similarity, label in neighbours[:1] if label == name)
+        nearest_other.append(next(similarity for similarity, label in neighbours if label != name))
+    print(f"Nearest neighbour, same species:  {quantiles(same)}")
+    print(f"Nearest neighbour, other species: {quantiles(nearest_other)}")
+
+    copies = [dot(image_features(data), image_features(reencoded(data))) for name in species for data in photos[name][:2]]
+    print(f"Re-encoded copy of a photo:       {quantiles(copies)}")
+    if not args.photos:
+        shots = []
+        for name in species:
+            first, (x, y, scale, facing) = synthetic_photo(name, random.Random(args.seed), background='sky')
+            second, _ = synthetic_photo(name, random.Random(args.seed + 1), background='sky', bird=(x + 25, y + 10, scale, facing))
+            shots.append(dot(image_features(first), image_features(second)))
+        print(f"Another shot of the same scene:   {quantiles(shots)}")
+
+
+def unit(values):
+    norm = math.sqrt(sum(value * value for value in values)) or 1
+    return [value / norm / math.sqrt(2) for value in values]
+
+
+def synthetic_vectors(count, species, noise, seed=0):
+    """Vectors shaped like image_features output, a non-negative and a signed half, around one centre per species."""
+    centres_rng = random.Random(species)
+    colours = FEATURE_DIM * 2 // 3
+    centres = [
+        [centres_rng.random() ** 3 for _ in range(colours)] + [centres_rng.gauss(0, 1) for _ in range(FEATURE_DIM - colours)]
+        for _ in range(species)
+    ]
+    rng = random.Random(seed)
+    for i in range(count):
+        label = i % species
+        centre = centres[label]
+        colour = [max(0.0, value + rng.gauss(0, noise)) for value in centre[:colours]]
+        layout = [value + rng.gauss(0, noise * 10) for value in centre[colours:]]
+        yield unit(colour) + unit(layout), f'Species {label}'
+
+
+def query_latency(index, queries, k):
+    timings = []
+    for features, _ in queries:
+        started = time.perf_counter()
+        index.search(features, k)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def latency(args):
+    path = os.path.join(tempfile.mkdtemp(), 'features.idx')
+    try:
+        index = FeatureIndex(path)
+        started = time.perf_counter()
+        for features, species in synthetic_vectors(args.entries, args.species, args.noise):
+            index.add(features, species)
+        elapsed = time.perf_counter() - started
+        print(f"Added {args.entries} entries in {elapsed:.1f}s ({args.entries / elapsed:.0f}/s), "
+              f"file {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+
+        queries = list(synthetic_vectors(args.queries, args.species, args.noise, seed=1))
+        backends = [('numpy', True)] if _numpy() else []
+        backends.append(('python', False))
+        for backend, use_numpy in backends:
+            fresh = FeatureIndex(path, use_numpy=use_numpy)
+            started = time.perf_counter()
+            fresh.search(queries[0][0], args.k)  # loads the file and, for numpy, builds the matrix
+            load = time.perf_counter() - started
+            sample = queries if use_numpy else queries[:args.python_queries]
+            median, p95 = query_latency(fresh, sample, args.k)
+            correct = sum(fresh.search(features, 1)[0][1] == species for features, species in sample)
+            print(f"{backend:<7} load={load * 1000:8.1f}ms query p50={median * 1000:8.2f}ms "
+                  f"p95={p95 * 1000:8.2f}ms nearest correct {correct}/{len(sample)}")
+        if not _numpy():
+            print("numpy is not installed, only the pure Python search was measured")
+    finally:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photos', help='Folder of labelled photos, one subfolder per species')
+    parser.add_argument('--per-species', type=int, default=16, help='Synthetic photos per species')
+    parser.add_argument('--unknown', type=int, default=2, help='Species left out of the index')
+    parser.add_argument('--min-similarity', type=float, nargs='+', default=[0.9, 0.92, 0.94, 0.96, 0.97])
+    parser.add_argument('--min-confidence', type=float, default=0.8)
+    parser.add_argument('--min-votes', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--entries', type=int, default=100000, help='Index size for the latency part, 0 skips it')
+    parser.add_argument('--species', type=int, default=1000)
+    parser.add_argument('--noise', type=float, default=0.05, help='Spread of each synthetic species cluster')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--python-queries', type=int, default=5, help='Queries for the slower pure Python search')
+    parser.add_argument('-k', type=int, default=5)
+    args = parser.parse_args()
+
+    evaluate(folder_photos(args.photos) if args.photos else synthetic_photos(args.per_species, args.seed), args)
+    if args.entries:
+        latency(args)
+
+
+if __name__ == '__main__':
+    main()
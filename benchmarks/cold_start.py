@@ -0,0 +1,105 @@
+"""
+Cold-start benchmark: import time of main.py and the latency of the first requests.
+
+Each round starts a fresh interpreter, as a new serverless instance would, and
+times `import main`, the first GET /test and the first POST /identify-bird
+(against the local stubs in benchmarks/stubs.py, with zero upstream latency so
+only our own start-up work is measured). Also lists the heavy modules loaded
+by the import alone.
+
+    python benchmarks/cold_start.py --rounds 5
+    python benchmarks/cold_start.py --max-import-ms 250 --max-first-identify-ms 800
+
+Exits non-zero when a --max-* budget is exceeded, so it can gate a deploy.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import make_upload  # noqa: E402
+from stubs import SERVICES, StubConfig, start_stubs, stub_env  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only load once a request needs them
+WATCHED_MODULES = ('PIL', 'requests', 'urllib3', 'sqlite3', 'bs4', 'dotenv')
+
+CHILD = """
+import io, json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+loaded = [name for name in {watched!r} if name in sys.modules]
+client = main.app.test_client()
+client.get('/test')
+tested = time.perf_counter()
+with open({upload_path!r}, 'rb') as f:
+    upload = f.read()
+response = client.post('/identify-bird', data={{'image': (io.BytesIO(upload), 'bird.jpg')}})
+identified = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'first_test_ms': (tested - imported) * 1000,
+    'first_identify_ms': (identified - tested) * 1000,
+    'status': response.status_code,
+    'loaded_at_import': loaded,
+}}))
+"""
+
+
+def run_round(env, upload_path):
+    code = CHILD.format(watched=WATCHED_MODULES, upload_path=upload_path)
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float, help='Fail if the median import time is higher')
+    parser.add_argument('--max-first-identify-ms', type=float,
+                        help='Fail if the median first /identify-bird time is higher')
+    args = parser.parse_args()
+
+    stubs = start_stubs(StubConfig(latency={service: 0 for service in SERVICES}, jitter=0))
+    env = dict(os.environ, **stub_env(f'http://127.0.0.1:{stubs.server_port}'))
+    env.update(LOG_LEVEL='WARNING', PYTHONDONTWRITEBYTECODE='1')
+
+    upload_path = os.path.join(REPO_ROOT, 'benchmarks', '.cold_start_upload.jpg')
+    with open(upload_path, 'wb') as f:
+        f.write(make_upload(0))
+    try:
+        # Warm the OS file cache and bytecode so rounds measure start-up work, not disk reads
+        run_round(env, upload_path)
+        rounds = [run_round(env, upload_path) for _ in range(args.rounds)]
+    finally:
+        os.remove(upload_path)
+        stubs.shutdown()
+
+    failed = False
+    for key in ('import_ms', 'first_test_ms', 'first_identify_ms'):
+        values = [result[key] for result in rounds]
+        print(f"{key:<18} median={statistics.median(values):8.1f} min={min(values):8.1f} max={max(values):8.1f}")
+    print(f"loaded at import: {', '.join(rounds[-1]['loaded_at_import']) or 'none of ' + ', '.join(WATCHED_MODULES)}")
+    if any(result['status'] != 200 for result in rounds):
+        print('First /identify-bird failed', file=sys.stderr)
+        failed = True
+
+    if args.max_import_ms is not None and statistics.median(r['import_ms'] for r in rounds) > args.max_import_ms:
+        failed = True
+    if (args.max_first_identify_ms is not None
+            and statistics.median(r['first_identify_ms'] for r in rounds) > args.max_first_identify_ms):
+        failed = True
+    if failed:
+        print('Cold-start budget exceeded', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Offline load and latency benchmark for /identify-bird.
+
+Starts the local stubs (benchmarks/stubs.py), then for every gunicorn
+workers x threads setting in --matrix boots the app pointed at the stubs,
+sends --requests uploads with --concurrency clients and reports p50/p95/p99
+latency, requests per second and the error rate.
+
+    python benchmarks/load.py --matrix 1x4,2x8 --requests 200 --concurrency 16
+    python benchmarks/load.py --latency together=8 --error-rate together=0.2 --max-p95 6
+
+Exits non-zero when --max-p95 or --max-error-rate is exceeded, so it can gate a deploy.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stubs import add_stub_arguments, config_from_args, start_stubs, stub_env  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_upload(index, size=(1600, 1200)):
+    """A distinct JPEG per request so neither hash matches another upload."""
+    rng = random.Random(index)
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3)))
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        box = (x, y, min(size[0], x + rng.randrange(50, 600)), min(size[1], y + rng.randrange(50, 600)))
+        image.paste(tuple(rng.randrange(256) for _ in range(3)), box)
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[rank]
+
+
+def start_app(workers, threads, env, port):
+    command = [
+        sys.executable, '-m', 'gunicorn', 'main:app',
+        '--workers', str(workers), '--threads', str(threads),
+        '--bind', f'127.0.0.1:{port}', '--timeout', '120', '--log-level', 'warning',
+    ]
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited: {process.stderr.read().decode()[-2000:]}")
+        try:
+            requests.get(f'http://127.0.0.1:{port}/test', timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('gunicorn did not start within 30s')
+
+
+def run_load(url, uploads, concurrency, path):
+    latencies, statuses, sizes = [], [], []
+
+    def send(upload):
+        started = time.perf_counter()
+        try:
+            response = requests.post(f'{url}{path}', files={'image': ('bird.jpg', upload, 'image/jpeg')}, timeout=120)
+            status, size = response.status_code, len(response.content)
+        except requests.RequestException:
+            status, size = 0, 0
+        return time.perf_counter() - started, status, size
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency, status, size in executor.map(send, uploads):
+            latencies.append(latency)
+            statuses.append(status)
+            sizes.append(size)
+    wall = time.perf_counter() - started
+
+    ok = [latency for latency, status in zip(latencies, statuses) if status == 200]
+    return {
+        'requests': len(uploads),
+        'errors': sum(1 for status in statuses if status != 200),
+        'error_rate': round(sum(1 for status in statuses if status != 200) / len(uploads), 4),
+        'rps': round(len(uploads) / wall, 2),
+        'p50': round(percentile(ok, 50), 3),
+        'p95': round(percentile(ok, 95), 3),
+        'p99': round(percentile(ok, 99), 3),
+        'mean_response_bytes': int(sum(sizes) / len(sizes)),
+    }
+
+
+def parse_matrix(value):
+    settings = []
+    for item in value.split(','):
+        workers, _, threads = item.partition('x')
+        settings.append((int(workers), int(threads or 1)))
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--matrix', type=parse_matrix, default=parse_matrix('1x4,2x8'),
+                        help='Comma separated gunicorn WORKERSxTHREADS settings')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--path', default='/identify-bird')
+    parser.add_argument('--warm-species-cache', action='store_true',
+                        help='Keep the species image and description caches enabled (default: cold)')
+    parser.add_argument('--json-out', help='Write the results to this file')
+    parser.add_argument('--max-p95', type=float, help='Fail if any setting has a higher p95 in seconds')
+    parser.add_argument('--max-error-rate', type=float, help='Fail if any setting has a higher error rate')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stubs = start_stubs(config_from_args(args))
+    env = dict(os.environ, **stub_env(f'http://127.0.0.1:{stubs.server_port}'))
+    # Every upload is new, and by default every species lookup goes upstream too
+    env.update(RESULT_CACHE_SIZE='0', LOG_LEVEL='WARNING')
+    if not args.warm_species_cache:
+        env.update(IMAGE_CACHE_SIZE='0', CONTENT_CACHE_SIZE='0')
+
+    uploads = [make_upload(i) for i in range(args.requests)]
+    print(f"Upload size: {sum(map(len, uploads)) // len(uploads) // 1024} KiB average")
+
+    results = []
+    failed = False
+    for workers, threads in args.matrix:
+        port = free_port()
+        process = start_app(workers, threads, env, port)
+        try:
+            result = run_load(f'http://127.0.0.1:{port}', uploads, args.concurrency, args.path)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+        result.update(workers=workers, threads=threads)
+        results.append(result)
+        print(
+            f"{workers}x{threads:<3} p50={result['p50']:.3f}s p95={result['p95']:.3f}s p99={result['p99']:.3f}s "
+            f"rps={result['rps']:.2f} errors={result['error_rate']:.1%} body={result['mean_response_bytes']}B"
+        )
+        if args.max_p95 is not None and result['p95'] > args.max_p95:
+            failed = True
+        if args.max_error_rate is not None and result['error_rate'] > args.max_error_rate:
+            failed = True
+
+    print(f"Upstream requests: {json.dumps(stubs.RequestHandlerClass.config.requests)}")
+    stubs.shutdown()
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        print('Performance budget exceeded', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
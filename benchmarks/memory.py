@@ -0,0 +1,121 @@
+"""
+Peak memory per concurrent request for /identify-bird.
+
+Boots one gunicorn worker with --concurrency threads against the local stubs
+(benchmarks/stubs.py), sends --concurrency large uploads at once for --rounds
+rounds and samples the worker's resident set size while they run. Reports
+the idle RSS, the peak RSS and the peak growth divided by the requests in flight.
+
+    python benchmarks/memory.py --upload-mb 8 --concurrency 8
+
+Reads /proc, so it runs on Linux only.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load import free_port, start_app  # noqa: E402
+from stubs import add_stub_arguments, config_from_args, start_stubs, stub_env  # noqa: E402
+
+
+def noisy_upload(index, megabytes):
+    """A JPEG of roughly `megabytes` MB; noise keeps it from compressing away."""
+    rng = random.Random(index)
+    side = int((megabytes * 1024 * 1024 / 1.1) ** 0.5)
+    noise = [Image.effect_noise((side, side), 40 + rng.randrange(20)) for _ in range(3)]
+    image = Image.merge('RGB', noise)
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=95)
+    return output.getvalue()
+
+
+def worker_pid(master_pid):
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+        children = f.read().split()
+    return int(children[0])
+
+
+def rss_bytes(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.01):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            time.sleep(self.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--upload-mb', type=float, default=8)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--path', default='/identify-bird')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stubs = start_stubs(config_from_args(args))
+    env = dict(os.environ, **stub_env(f'http://127.0.0.1:{stubs.server_port}'))
+    # Every request does the full pipeline
+    env.update(RESULT_CACHE_SIZE='0', LOG_LEVEL='WARNING', MAX_UPLOAD_BYTES=str(int((args.upload_mb + 8) * 1024 * 1024)))
+
+    uploads = [noisy_upload(i, args.upload_mb) for i in range(args.concurrency * args.rounds)]
+    print(f"Upload size: {sum(map(len, uploads)) // len(uploads) // 1024} KiB average")
+
+    port = free_port()
+    url = f'http://127.0.0.1:{port}{args.path}'
+    process = start_app(1, args.concurrency, env, port)
+    try:
+        pid = worker_pid(process.pid)
+
+        def send(upload):
+            response = requests.post(url, files={'image': ('bird.jpg', upload, 'image/jpeg')}, timeout=120)
+            return response.status_code
+
+        # One request first so imports, pools and sessions are in the idle figure
+        send(noisy_upload(-1, 1))
+        idle = rss_bytes(pid)
+
+        sampler = RssSampler(pid)
+        sampler.start()
+        statuses = []
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for round_index in range(args.rounds):
+                batch = uploads[round_index * args.concurrency:(round_index + 1) * args.concurrency]
+                statuses.extend(executor.map(send, batch))
+        sampler.running = False
+        sampler.join()
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        stubs.shutdown()
+
+    errors = sum(1 for status in statuses if status != 200)
+    mib = 1024 * 1024
+    print(f"idle RSS {idle / mib:.1f} MiB, peak RSS {sampler.peak / mib:.1f} MiB, errors {errors}/{len(statuses)}")
+    print(f"peak growth per concurrent request: {(sampler.peak - idle) / args.concurrency / mib:.2f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+Local stand-ins for every upstream service main.py calls, for offline benchmarks.
+
+One threaded HTTP server answers for all of them, routed by path prefix:
+
+    /gemini/v1beta/models/<model>:generateContent   Gemini (and :streamGenerateContent)
+    /mistral/v1/chat/completions                     Mistral
+    /together/v1/chat/completions                    Together (Llama)
+    /wikipedia/w/api.php                             Wikipedia MediaWiki API
+    /commons/w/api.php                               Wikimedia Commons API
+    /bing/images/search                              Bing image search
+
+Responses have the shapes main.py parses, streamed as server-sent events
+when the request asks for it. Latency, jitter, error rate and
+payload sizes are configurable per service.
+
+    python benchmarks/stubs.py --port 8900 --latency gemini=1.2,wikipedia=0.08
+    eval "$(python benchmarks/stubs.py --port 8900 --print-env)"
+"""
+import argparse
+import html
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SERVICES = ('gemini', 'mistral', 'together', 'wikipedia', 'commons', 'bing')
+
+# Rough medians seen in production, in seconds
+DEFAULT_LATENCY = {
+    'gemini': 1.5,
+    'mistral': 2.0,
+    'together': 4.0,
+    'wikipedia': 0.12,
+    'commons': 0.15,
+    'bing': 0.4,
+}
+
+STREAM_CHUNK_CHARS = 64  # answer text per streamed event
+
+SPECIES = ['Indian Peafowl', 'House Crow', 'Common Myna', 'Rose-ringed Parakeet', 'Common Kingfisher']
+
+
+class StubConfig:
+    def __init__(self, latency=None, jitter=0.2, error_rate=None, description_kb=2, images_per_page=12,
+                 bing_page_kb=300, species=None, disagree_rate=0.1, seed=None):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.jitter = jitter
+        self.error_rate = error_rate or {}
+        self.description_kb = description_kb
+        self.images_per_page = images_per_page
+        self.bing_page_kb = bing_page_kb
+        self.species = species or SPECIES
+        self.disagree_rate = disagree_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {service: 0 for service in SERVICES}
+
+    def delay(self, service, fraction=1.0):
+        """
+        Sleeps for `fraction` of the service's latency, with +/- `jitter` relative noise.
+        Returns the whole latency, so a caller can spend the rest streaming.
+        """
+        with self.lock:
+            self.requests[service] += 1
+            noise = self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        latency = max(self.latency.get(service, 0) * noise, 0)
+        time.sleep(latency * fraction)
+        return latency
+
+    def fails(self, service):
+        with self.lock:
+            return self.random.random() < self.error_rate.get(service, 0)
+
+    def pick_species(self):
+        with self.lock:
+            if self.random.random() < self.disagree_rate:
+                return self.random.choice(self.species)
+            return self.species[0]
+
+
+def _classification(config):
+    species = config.pick_species()
+    return json.dumps({'species': species, 'reason': f"Plumage and shape match a {species}."})
+
+
+def _content(config, prompt):
+    """Answer for the aggregation and description prompts."""
+    match = re.search(r'bird species "([^"]+)"', prompt)
+    species = match.group(1) if match else config.species[0]
+    paragraph = f"The **{species}** is a bird. " * 8
+    description = f"# {species}\n\n" + (paragraph + "\n\n") * max(1, config.description_kb * 1024 // len(paragraph))
+    return json.dumps({
+        'species': species,
+        'description': description[:config.description_kb * 1024],
+        'variation_species': [name for name in config.species if name != species][:5],
+    })
+
+
+def _file_url(title):
+    name = title.split(':', 1)[-1].replace(' ', '_')
+    return f"https://upload.wikimedia.org/wikipedia/commons/a/ab/{name}"
+
+
+def bing_page(config, search):
+    """
+    A Bing image results page: script and markup filler around `.iusc` result anchors,
+    like the real page, which has large head and trailing script blocks.
+    """
+    anchors = []
+    for i in range(config.images_per_page * 3):
+        meta = json.dumps({'murl': f"https://images.example.org/{i}.jpg", 't': f"{search} {i}"})
+        anchors.append(f'<div class="imgpt"><a class="iusc" href="/images/{i}" m="{html.escape(meta)}">'
+                       f'<img src="https://tse.example.org/{i}.jpg" alt="{html.escape(search)}"></a></div>')
+    filler = '<div class="filler">' + 'x' * 1000 + '</div>'
+    head, tail = filler * (config.bing_page_kb // 2), filler * (config.bing_page_kb - config.bing_page_kb // 2)
+    return f"<html><head><title>{html.escape(search)}</title></head><body>{head}{''.join(anchors)}{tail}</body></html>"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        payload = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _service(self):
+        service = self.path.lstrip('/').split('/', 1)[0]
+        return service if service in SERVICES else None
+
+    def _fail_if_configured(self, service):
+        if self.config.fails(service):
+            self._send(503, json.dumps({'error': 'stubbed failure'}))
+            return True
+        return False
+
+    def _send_events(self, events, interval):
+        """Sends server-sent events `interval` seconds apart, like a model streaming tokens."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, event in enumerate(events):
+            if i:
+                time.sleep(interval)
+            data = event if isinstance(event, str) else json.dumps(event)
+            payload = f"data: {data}\r\n\r\n".encode()
+            self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        service = self._service()
+        if service not in ('gemini', 'mistral', 'together'):
+            return self._send(404, '{}')
+        stream = ':streamGenerateContent' in self.path or body.get('stream')
+
+        # A streamed answer starts after a third of the latency, the rest is spent generating
+        latency = self.config.delay(service, fraction=1 / 3 if stream else 1.0)
+        if self._fail_if_configured(service):
+            return
+
+        if service == 'gemini':
+            prompt = ' '.join(part.get('text', '') for part in body['contents'][0]['parts'])
+        else:
+            content = body['messages'][0]['content']
+            prompt = ' '.join(part.get('text', '') for part in content) if isinstance(content, list) else content
+        text = _content(self.config, prompt) if 'variation_species' in prompt else _classification(self.config)
+
+        if stream:
+            pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+            if service == 'gemini':
+                events = [{'candidates': [{'content': {'parts': [{'text': piece}], 'role': 'model'}}]} for piece in pieces]
+            else:
+                events = [{'choices': [{'index': 0, 'delta': {'content': piece}}]} for piece in pieces] + ['[DONE]']
+            return self._send_events(events, latency * 2 / 3 / len(pieces))
+
+        if service == 'gemini':
+            response = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}}]}
+        else:
+            response = {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}}]}
+        self._send(200, json.dumps(response))
+
+    def do_GET(self):
+        service = self._service()
+        if service is None:
+            return self._send(404, '{}')
+        self.config.delay(service)
+        if self._fail_if_configured(service):
+            return
+
+        query = {key: values[0] for key, values in parse_qs(urlsplit(self.path).query).items()}
+        if service == 'bing':
+            return self._send(200, bing_page(self.config, query.get('q', 'bird')), 'text/html; charset=utf-8')
+        self._send(200, json.dumps(self._mediawiki(query)))
+
+    def _mediawiki(self, query):
+        per_page = self.config.images_per_page
+        if query.get('action') == 'parse':
+            title = query.get('page', 'Bird').replace(' ', '_')
+            images = ['Commons-logo.svg'] + [f"{title}_{i}.jpg" for i in range(per_page)]
+            return {'parse': {'title': query.get('page'), 'pageid': 1, 'images': images}}
+
+        if query.get('generator') == 'search':
+            limit = int(query.get('gsrlimit', 10))
+            search = query.get('gsrsearch', 'bird').replace('"', '').replace(' ', '_')
+            pages = {
+                str(1000 + i): {
+                    'pageid': 1000 + i, 'ns': 6, 'title': f"File:{search}_{i}.jpg", 'index': i + 1,
+                    'imageinfo': [{'url': _file_url(f"File:{search}_{i}.jpg")}],
+                }
+                for i in range(limit)
+            }
+            return {'query': {'pages': pages}}
+
+        titles = [title for title in query.get('titles', '').split('|') if title]
+        pages = {
+            str(2000 + i): {'pageid': 2000 + i, 'ns': 6, 'title': title, 'imageinfo': [{'url': _file_url(title)}]}
+            for i, title in enumerate(titles)
+        }
+        return {'query': {'pages': pages}}
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading early (the streamed Bing scan) reset the connection
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start_stubs(config=None, host='127.0.0.1', port=0):
+    """Starts the stub server on a background thread and returns it; the port is server.server_port."""
+    handler = type('ConfiguredStubHandler', (StubHandler,), {'config': config or StubConfig()})
+    server = StubServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='stubs', daemon=True).start()
+    return server
+
+
+def stub_env(base_url):
+    """Environment variables that point main.py at the stubs."""
+    return {
+        'GEMINI_API_BASE': f"{base_url}/gemini",
+        'MISTRAL_API_BASE': f"{base_url}/mistral",
+        'TOGETHER_API_BASE': f"{base_url}/together",
+        'WIKIPEDIA_API_URL': f"{base_url}/wikipedia/w/api.php",
+        'COMMONS_API_URL': f"{base_url}/commons/w/api.php",
+        'BING_BASE_URL': f"{base_url}/bing",
+        'GEMINI_API_KEY': 'stub',
+        'MISTRAL_API_KEY': 'stub',
+        'TOGETHER_API_KEY': 'stub',
+    }
+
+
+def parse_per_service(value):
+    """Parses 'gemini=1.2,bing=0.3' into {'gemini': 1.2, 'bing': 0.3}."""
+    result = {}
+    for item in filter(None, (value or '').split(',')):
+        service, _, number = item.partition('=')
+        if service not in SERVICES:
+            raise argparse.ArgumentTypeError(f"Unknown service '{service}', expected one of {', '.join(SERVICES)}")
+        result[service] = float(number)
+    return result
+
+
+def add_stub_arguments(parser):
+    parser.add_argument('--latency', type=parse_per_service, default={},
+                        help='Per-service latency in seconds, e.g. gemini=1.2,wikipedia=0.05')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Relative latency noise (0.2 = +/-20%%)')
+    parser.add_argument('--error-rate', type=parse_per_service, default={},
+                        help='Per-service fraction of 503 responses, e.g. together=0.1')
+    parser.add_argument('--description-kb', type=int, default=2, help='Size of generated descriptions')
+    parser.add_argument('--images-per-page', type=int, default=12, help='Images on each stub article')
+    parser.add_argument('--bing-page-kb', type=int, default=300, help='Size of the Bing results page')
+    parser.add_argument('--disagree-rate', type=float, default=0.1,
+                        help='Chance a provider answers with a random species')
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def config_from_args(args):
+    return StubConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        description_kb=args.description_kb,
+        images_per_page=args.images_per_page,
+        bing_page_kb=args.bing_page_kb,
+        disagree_rate=args.disagree_rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--print-env', action='store_true', help='Print export lines for main.py and exit')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    base_url = f"http://{args.host}:{args.port}"
+    if args.print_env:
+        for key, value in stub_env(base_url).items():
+            print(f"export {key}={value}")
+        return
+
+    server = start_stubs(config_from_args(args), args.host, args.port)
+    print(f"Stubs listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import html
+import json
+import re
+
+# Opening tags of Bing's image result anchors, e.g. <a class="iusc" m="{...}">.
+# Attribute values are HTML-escaped, so a raw '>' can only end the tag.
+_IUSC_TAG = re.compile(rb'<a\s[^>]*?(?<![\w-])class\s*=\s*["\'][^"\'>]*\biusc\b[^>]*>', re.IGNORECASE)
+_ATTRIBUTE = re.compile(rb'(?<![\w-])(m|data-src)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+
+
+def _tag_image_url(tag):
+    """The full-size image URL of one result anchor: data-src if present, else the `murl` in its m JSON."""
+    attributes = {
+        match.group(1).lower(): match.group(2) if match.group(2) is not None else match.group(3)
+        for match in _ATTRIBUTE.finditer(tag)
+    }
+    if b'data-src' in attributes:
+        return html.unescape(attributes[b'data-src'].decode('utf-8', 'replace'))
+    if b'm' in attributes:
+        try:
+            data = json.loads(html.unescape(attributes[b'm'].decode('utf-8', 'replace')))
+        except ValueError:
+            return None
+        murl = data.get('murl') if isinstance(data, dict) else None
+        return murl if isinstance(murl, str) else None
+    return None
+
+
+def extract_image_urls(chunks, max_images):
+    """
+    Image URLs from a Bing image results page, read as an iterable of byte chunks.
+    Only the result anchors are decoded, and reading stops once `max_images`
+    URLs are found, so the rest of the page is never downloaded or scanned.
+    """
+    urls = []
+    if max_images <= 0:
+        return urls
+    pending = b''
+    for chunk in chunks:
+        buffer = pending + chunk
+        position = 0
+        for match in _IUSC_TAG.finditer(buffer):
+            position = match.end()
+            url = _tag_image_url(match.group())
+            if url:
+                urls.append(url)
+                if len(urls) >= max_images:
+                    return urls
+        # Keep a tag cut in half by the chunk boundary for the next round
+        start = buffer.rfind(b'<', position)
+        pending = buffer[start:] if start != -1 and buffer.find(b'>', start) == -1 else b''
+    return urls
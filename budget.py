@@ -0,0 +1,83 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+# Outbound calls are not started with less time than this left
+MIN_CALL_SECONDS = 0.05
+
+_deadline = contextvars.ContextVar('request_deadline', default=None)  # time.monotonic() value
+_omitted = contextvars.ContextVar('omitted_stages', default=None)
+
+
+class BudgetExhausted(Exception):
+    """The request's time budget ran out."""
+
+
+@contextmanager
+def request_budget(seconds, started=None):
+    """
+    Runs the block, and any work it submits through metrics.submit, against a
+    deadline `seconds` after `started`, a time.monotonic() value defaulting to now.
+    A budget inside another can only shorten it; a falsy `seconds` adds none.
+    Stages recorded with `omit` inside the block are listed by `omitted`.
+    """
+    deadline = _deadline.get()
+    if seconds:
+        own = (time.monotonic() if started is None else started) + seconds
+        deadline = own if deadline is None else min(deadline, own)
+    deadline_token = _deadline.set(deadline)
+    omitted_token = _omitted.set([])
+    try:
+        yield
+    finally:
+        _omitted.reset(omitted_token)
+        _deadline.reset(deadline_token)
+
+
+def remaining():
+    """Seconds left in the current budget, never negative, or None without a budget."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def allows(seconds):
+    """Whether at least `seconds` are left. Always true without a budget."""
+    left = remaining()
+    return left is None or left >= seconds
+
+
+def cap(seconds):
+    """`seconds` limited to the time left; a None `seconds` means no limit of its own."""
+    left = remaining()
+    if left is None:
+        return seconds
+    return left if seconds is None else min(seconds, left)
+
+
+def timeout(value):
+    """
+    An HTTP timeout, a number or a (connect, read) pair, capped at the time left.
+    Raises BudgetExhausted when too little is left to start the call.
+    """
+    left = remaining()
+    if left is None:
+        return value
+    if left < MIN_CALL_SECONDS:
+        raise BudgetExhausted('Request budget exhausted')
+    if isinstance(value, tuple):
+        return tuple(left if part is None else min(part, left) for part in value)
+    return left if value is None else min(value, left)
+
+
+def omit(stage):
+    """Records that an optional stage was skipped or cut short for lack of time."""
+    stages = _omitted.get()
+    if stages is not None and stage not in stages:
+        stages.append(stage)
+
+
+def omitted():
+    """Stages omitted so far under the current budget."""
+    return list(_omitted.get() or ())
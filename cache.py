@@ -0,0 +1,253 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import budget
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Two-tier cache: an in-process LRU in front of an optional SQLite file.
+    The SQLite tier survives restarts and is shared by every gunicorn worker
+    pointing at the same path. Values must be JSON serializable.
+    """
+
+    def __init__(self, name, max_entries=1024, ttl=86400, negative_ttl=600, db_path=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db_path = db_path
+
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> Future of the fetch in progress
+        self._local = threading.local()
+        self._counters = {
+            'hits': 0,
+            'disk_hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+        }
+
+        if db_path:
+            self._db().execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT, key TEXT, value TEXT, expires_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+
+    def _db(self):
+        """Returns this thread's SQLite connection."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, key):
+        """Returns (found, value) without touching upstream."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    if not entry[1]:
+                        self._counters['negative_hits'] += 1
+                    return True, entry[1]
+                del self._entries[key]
+
+        if self.db_path:
+            import sqlite3  # only caches with a database file pay for the import
+            try:
+                row = self._db().execute(
+                    "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                    (self.name, key)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Cache '{self.name}' read failed: {str(e)}")
+                row = None
+            if row and row[1] > now:
+                value = json.loads(row[0])
+                self._store(key, value, row[1])
+                self._count('disk_hits')
+                if not value:
+                    self._count('negative_hits')
+                return True, value
+
+        self._count('misses')
+        return False, None
+
+    def set(self, key, value, ttl=None):
+        """Stores a value; empty values use the shorter negative TTL unless `ttl` is given."""
+        if ttl is None:
+            ttl = self.ttl if value else self.negative_ttl
+        expires_at = time.time() + ttl
+        self._store(key, value, expires_at)
+
+        if self.db_path:
+            import sqlite3
+            try:
+                self._db().execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (self.name, key, json.dumps(value), expires_at)
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Cache '{self.name}' write failed: {str(e)}")
+
+    def _store(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for `key`, calling `compute()` on a miss.
+        Concurrent misses for the same key wait for a single call to `compute`.
+        Exceptions from `compute` are raised to every waiter and never cached, except
+        that the leader running out of its request budget is not passed on: a waiter
+        with time left computes the value itself. Waiters wait within their own budget.
+        """
+        found, value = self.get(key)
+        if found:
+            return value
+
+        with self._lock:
+            # Another thread may have finished the fetch since our lookup
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self._counters['coalesced'] += 1
+
+        if not leader:
+            try:
+                return future.result(timeout=budget.remaining())
+            except budget.BudgetExhausted:
+                # The leader's request ran out of time, which says nothing about ours
+                return self.get_or_compute(key, compute)
+            except FutureTimeoutError:
+                raise budget.BudgetExhausted(f"Gave up waiting for '{key}' at the request deadline") from None
+
+        try:
+            value = compute()
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.db_path:
+            self._db().execute("DELETE FROM cache WHERE namespace = ?", (self.name,))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['disk_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+class ResultCache:
+    """
+    In-process cache of identification results for uploaded photos.
+    Entries are found by exact content hash, or by perceptual hash within
+    `max_distance` bits so re-encoded or resized copies of a photo also hit.
+    Eviction is least recently used, bounded by entry count and total size.
+    """
+
+    def __init__(self, max_entries=512, max_bytes=64 * 1024 * 1024, max_distance=4, ttl=86400):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_distance = max_distance
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # content hash -> (expires_at, perceptual hash, size, result)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            'exact_hits': 0,
+            'perceptual_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def get(self, content_hash, perceptual_hash=None):
+        """Returns the cached result for an upload, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(content_hash)
+                self._counters['exact_hits'] += 1
+                return entry[3]
+
+            if perceptual_hash is not None and self.max_distance >= 0:
+                best_key, best_distance = None, self.max_distance + 1
+                for key, (expires_at, other_hash, _, _) in self._entries.items():
+                    if other_hash is None or expires_at <= now:
+                        continue
+                    distance = (perceptual_hash ^ other_hash).bit_count()
+                    if distance < best_distance:
+                        best_key, best_distance = key, distance
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self._counters['perceptual_hits'] += 1
+                    return self._entries[best_key][3]
+
+            self._counters['misses'] += 1
+            return None
+
+    def set(self, content_hash, perceptual_hash, result):
+        size = len(json.dumps(result))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(content_hash, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[content_hash] = (time.time() + self.ttl, perceptual_hash, size, result)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self._counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
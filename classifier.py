@@ -0,0 +1,248 @@
+import heapq
+import logging
+import os
+import struct
+import threading
+from array import array
+from collections import namedtuple
+from operator import mul
+
+from imaging import FEATURE_DIM, image_features
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BIRDKNN2'
+_HEADER = struct.Struct('<8sHH4x')  # magic, vector dimension, label field size
+LABEL_BYTES = 64
+# Feature components are within +/- 1/sqrt(2), stored as one byte each around ZERO
+SCALE = 180
+ZERO = 128
+
+Match = namedtuple('Match', ['species', 'confidence', 'votes', 'neighbours'])
+
+
+def _numpy():
+    """numpy when installed, it makes queries on large indexes much faster. None otherwise."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class FeatureIndex:
+    """
+    Append-only nearest-neighbour index of image feature vectors and their species.
+    On disk it is a header followed by fixed-size records, a null-padded UTF-8
+    label and the vector quantized to one offset byte per component, so adding an entry
+    is a single append and every gunicorn worker picks up the others' appends
+    on its next query. In memory the vectors sit in one flat bytearray.
+    Search is exact, with numpy when available and in pure Python otherwise.
+    """
+
+    def __init__(self, path=None, dim=FEATURE_DIM, use_numpy=True):
+        self.path = path
+        self.dim = dim
+        self.record_size = LABEL_BYTES + dim
+
+        self._vectors = bytearray()
+        self._labels = array('I')  # per entry, index into _species
+        self._species = []
+        self._species_ids = {}
+        self._offset = 0  # bytes of the file read so far
+        self.use_numpy = use_numpy
+        self._numpy = False  # resolved on the first search, numpy is slow to import
+        self._matrix = None  # float32 copy of _vectors for numpy, grown as entries arrive
+        self._matrix_rows = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self._refresh()
+        return len(self._labels)
+
+    def _refresh(self):
+        """Reads records appended to the file since the last read, by any process."""
+        if not self.path:
+            return
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        with self._lock:
+            if size <= self._offset:
+                return
+            first_read = not self._offset
+            try:
+                with open(self.path, 'rb') as f:
+                    if not self._offset:
+                        magic, dim, label_bytes = _HEADER.unpack(f.read(_HEADER.size))
+                        if magic != MAGIC or dim != self.dim or label_bytes != LABEL_BYTES:
+                            raise ValueError('not a feature index of this format')
+                        self._offset = _HEADER.size
+                    f.seek(self._offset)
+                    # A record still being appended is left for the next refresh
+                    whole = (size - self._offset) // self.record_size * self.record_size
+                    data = f.read(whole)
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"Ignoring feature index '{self.path}': {str(e)}")
+                self.path = None
+                return
+            for start in range(0, len(data), self.record_size):
+                label = data[start:start + LABEL_BYTES].rstrip(b'\0').decode('utf-8', 'replace')
+                self._append(label, data[start + LABEL_BYTES:start + self.record_size])
+            self._offset += len(data)
+            if first_read:
+                logger.info(f"Loaded feature index '{self.path}' with {len(self._labels)} entries")
+
+    def _append(self, species, quantized):
+        species_id = self._species_ids.get(species)
+        if species_id is None:
+            species_id = self._species_ids[species] = len(self._species)
+            self._species.append(species)
+        self._labels.append(species_id)
+        self._vectors += quantized
+
+    def add(self, features, species):
+        """Adds one vector labelled with `species`, persisting it when the index has a file."""
+        quantized = bytes(max(0, min(255, ZERO + round(value * SCALE))) for value in features)
+        self._refresh()
+        if not self.path:
+            with self._lock:
+                self._append(species, quantized)
+            return
+        label = species.encode('utf-8')[:LABEL_BYTES].decode('utf-8', 'ignore').encode('utf-8')
+        try:
+            with open(self.path, 'xb') as f:
+                f.write(_HEADER.pack(MAGIC, self.dim, LABEL_BYTES))
+        except FileExistsError:
+            pass
+        # One write per record, O_APPEND keeps concurrent writers from interleaving
+        with open(self.path, 'ab') as f:
+            f.write(label.ljust(LABEL_BYTES, b'\0') + quantized)
+        self._refresh()
+
+    def uses_numpy(self):
+        """Whether searches run on numpy."""
+        if self._numpy is False:
+            self._numpy = _numpy() if self.use_numpy else None
+        return self._numpy is not None
+
+    def _similarities(self, features):
+        """Cosine similarity of `features` to every entry, in entry order."""
+        self.uses_numpy()
+        np = self._numpy
+        with self._lock:
+            count = len(self._labels)
+            if np is None:
+                vectors = memoryview(self._vectors)
+                dim = self.dim
+                # The stored bytes are offset by ZERO, take it back out once per query
+                offset = ZERO * sum(features)
+                return [(sum(map(mul, vectors[i * dim:(i + 1) * dim], features)) - offset) / SCALE for i in range(count)]
+
+            if self._matrix is None or len(self._matrix) < count:
+                # Grow by doubling so incremental adds stay cheap
+                grown = np.empty((max(count, 2 * self._matrix_rows, 1024), self.dim), dtype=np.float32)
+                if self._matrix is not None:
+                    grown[:self._matrix_rows] = self._matrix[:self._matrix_rows]
+                self._matrix = grown
+            if self._matrix_rows < count:
+                tail = np.frombuffer(self._vectors, dtype=np.uint8, offset=self._matrix_rows * self.dim)
+                self._matrix[self._matrix_rows:count] = (tail.reshape(-1, self.dim).astype(np.float32) - ZERO) / SCALE
+                self._matrix_rows = count
+            matrix = self._matrix[:count]
+        return matrix @ np.asarray(features, dtype=np.float32)
+
+    def search(self, features, k=5):
+        """The `k` most similar entries as (similarity, species) pairs, most similar first."""
+        self._refresh()
+        similarities = self._similarities(features)
+        if not len(similarities):
+            return []
+        np = self._numpy
+        if np is None:
+            best = heapq.nlargest(k, range(len(similarities)), key=similarities.__getitem__)
+        else:
+            best = np.argpartition(-similarities, k)[:k] if len(similarities) > k else np.arange(len(similarities))
+            best = sorted(best, key=lambda i: -similarities[i])
+        return [(float(similarities[i]), self._species[self._labels[i]]) for i in best]
+
+
+class NearestNeighbourClassifier:
+    """
+    First identification tier, run before the remote providers. It answers when
+    at least `min_votes` of the `k` nearest past identifications are at least
+    `min_similarity` alike and agree on a species by `min_confidence` of the
+    similarity weight; otherwise it returns None and the providers decide.
+    Without numpy, an index past `python_max_entries` is too slow to search on the
+    request thread, so the tier then stops answering and `learn` skips its duplicate check.
+    Other first tiers only need the same `features`, `classify`, `learn` and `stats`.
+    """
+
+    def __init__(self, index, k=5, min_similarity=0.96, min_confidence=0.8, min_votes=3,
+                 duplicate_similarity=0.998, python_max_entries=10000):
+        self.index = index
+        self.k = k
+        self.min_similarity = min_similarity
+        self.min_confidence = min_confidence
+        self.min_votes = min_votes
+        self.duplicate_similarity = duplicate_similarity
+        self.python_max_entries = python_max_entries
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'learned': 0, 'duplicates': 0, 'skipped': 0}
+        self._warned = False
+
+    def _too_slow(self):
+        if self.index.uses_numpy() or len(self.index) <= self.python_max_entries:
+            return False
+        if not self._warned:
+            self._warned = True
+            logger.warning(f"Feature index has over {self.python_max_entries} entries and numpy is not installed, "
+                           "the local tier stops answering")
+        return True
+
+    def features(self, image_data):
+        return image_features(image_data)
+
+    def classify(self, features):
+        """A Match for `features`, or None when the answer is not confident enough."""
+        if features is None:
+            return None
+        if self._too_slow():
+            self._count('skipped')
+            return None
+        neighbours = self.index.search(features, self.k)
+        weights = {}
+        for similarity, species in neighbours:
+            if similarity >= self.min_similarity:
+                weights[species] = weights.get(species, 0) + similarity
+        match = None
+        if weights:
+            species = max(weights, key=weights.get)
+            votes = sum(1 for similarity, name in neighbours if name == species and similarity >= self.min_similarity)
+            confidence = weights[species] / sum(max(similarity, 0) for similarity, _ in neighbours)
+            if votes >= self.min_votes and confidence >= self.min_confidence:
+                match = Match(species, confidence, votes, neighbours)
+        self._count('hits' if match else 'misses')
+        return match
+
+    def learn(self, features, species):
+        """
+        Records a confirmed identification. Copies of a known entry of the same species,
+        at least `duplicate_similarity` alike, are skipped.
+        """
+        if features is None:
+            return
+        nearest = [] if self._too_slow() else self.index.search(features, 1)
+        if nearest and nearest[0][0] >= self.duplicate_similarity and nearest[0][1] == species:
+            self._count('duplicates')
+            return
+        self.index.add(features, species)
+        self._count('learned')
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self):
+        return dict(self._counters, entries=len(self.index))
@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProviderHealth:
+    """
+    Rolling latency and error statistics for one upstream provider, plus a circuit breaker.
+
+    The circuit opens after `failure_threshold` consecutive failures, or when at least
+    `error_rate_threshold` of the recent window failed. While open, calls are refused
+    for `cooldown` seconds; then a single trial call is let through (half-open) and its
+    outcome closes or re-opens the circuit. A trial that reports nothing within
+    `trial_timeout` seconds (default `cooldown`) is given up and another is let through.
+    """
+
+    def __init__(self, name, window=50, min_samples=10, failure_threshold=5,
+                 error_rate_threshold=0.5, cooldown=30, trial_timeout=None):
+        self.name = name
+        self.min_samples = min_samples
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.cooldown = cooldown
+        self.trial_timeout = cooldown if trial_timeout is None else trial_timeout
+
+        self._samples = deque(maxlen=window)  # (latency seconds, succeeded)
+        self._consecutive_failures = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """True if a call may go out now. In half-open state only one trial call is allowed."""
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.cooldown:
+                    return False
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == HALF_OPEN:
+                now = time.monotonic()
+                if self._trial_in_flight and now - self._trial_started < self.trial_timeout:
+                    return False
+                self._trial_in_flight = True
+                self._trial_started = now
+            return True
+
+    def release(self):
+        """Gives back a half-open trial slot whose call never went out."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record(self, latency, succeeded):
+        with self._lock:
+            self._samples.append((latency, succeeded))
+            if succeeded:
+                self._consecutive_failures = 0
+                if self._state != CLOSED:
+                    logger.info(f"Circuit for '{self.name}' closed")
+                self._state = CLOSED
+                return
+
+            self._consecutive_failures += 1
+            failures = sum(1 for _, ok in self._samples if not ok)
+            error_rate = failures / len(self._samples)
+            if (
+                self._state == HALF_OPEN
+                or self._consecutive_failures >= self.failure_threshold
+                or (len(self._samples) >= self.min_samples and error_rate >= self.error_rate_threshold)
+            ):
+                if self._state != OPEN:
+                    logger.warning(f"Circuit for '{self.name}' opened ({self._consecutive_failures} consecutive failures, "
+                                   f"{error_rate:.0%} errors)")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def percentile(self, pct):
+        """Latency percentile of recent successful calls, or None until there are enough samples."""
+        with self._lock:
+            latencies = sorted(latency for latency, ok in self._samples if ok)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(round(pct / 100 * (len(latencies) - 1))))]
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return HALF_OPEN
+            return self._state
+
+    def snapshot(self):
+        with self._lock:
+            samples = list(self._samples)
+        failures = sum(1 for _, ok in samples if not ok)
+        return {
+            'state': self.state,
+            'samples': len(samples),
+            'error_rate': round(failures / len(samples), 4) if samples else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+        }
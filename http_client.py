@@ -0,0 +1,213 @@
+import functools
+import json
+import logging
+import os
+import random
+import re
+import threading
+from urllib.parse import urlsplit
+
+import budget
+
+logger = logging.getLogger(__name__)
+
+# Defaults for every outbound call, overridable per call with `timeout=`
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+# Keep-alive connections per host; size it to the threads that call one host at once.
+# Unset, the app sizes it from its worker pools with size_pools.
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '16'))
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.5'))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_rate_limited_hosts = set()
+
+
+def rate_limited_host(url):
+    """
+    Leaves 429 answers from the host of `url` to the caller's rate limiter instead of
+    retrying them. A retry would sleep out Retry-After and skip the limiter, which learns
+    of the 429 only once the response is returned. Call before the host's first request.
+    """
+    _rate_limited_hosts.add(urlsplit(url).netloc)
+
+
+@functools.lru_cache(maxsize=None)
+def _retry_classes():
+    # Built on first use, importing requests and urllib3 is a large part of a cold start
+    from urllib3.util.retry import Retry
+
+    class JitteredRetry(Retry):
+        """
+        Exponential backoff with full jitter so retrying workers don't stampede a host.
+        Within a request budget, waits are cut to the time left and nothing is retried once it is gone.
+        """
+        retry_throttled = True
+
+        def get_backoff_time(self):
+            return budget.cap(random.uniform(0, super().get_backoff_time()))
+
+        def get_retry_after(self, response):
+            retry_after = super().get_retry_after(response)
+            return None if retry_after is None else budget.cap(retry_after)
+
+        def is_retry(self, method, status_code, has_retry_after=False):
+            if status_code == 429 and not self.retry_throttled:
+                return False  # urllib3 retries it whenever Retry-After is sent, whatever the forcelist
+            return budget.allows(budget.MIN_CALL_SECONDS) and super().is_retry(method, status_code, has_retry_after)
+
+    class LimitedHostRetry(JitteredRetry):
+        """For hosts whose 429 answers go back to the caller's rate limiter."""
+        retry_throttled = False
+
+    return JitteredRetry, LimitedHostRetry
+
+
+def size_pools(threads):
+    """
+    Keeps up to `threads` connections per host, the most threads that can call one
+    host at once, unless HTTP_POOL_SIZE is set. Applies to sessions opened afterwards.
+    """
+    global POOL_SIZE
+    if not os.getenv('HTTP_POOL_SIZE'):
+        POOL_SIZE = threads
+
+
+def session_for(url):
+    """Returns the pooled keep-alive session for the host of `url`, creating it on first use."""
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            jittered, limited = _retry_classes()
+            retry = (limited if host in _rate_limited_hosts else jittered)(
+                total=MAX_RETRIES,
+                connect=MAX_RETRIES,
+                read=0,  # a read timeout means the model is slow, retrying only doubles the wait
+                status=MAX_RETRIES,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=None,  # model calls are POSTs and safe to repeat
+                backoff_factor=BACKOFF_FACTOR,
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+            logger.info(f"Opened HTTP session pool for {host}")
+    return session
+
+
+def request(method, url, timeout=None, **kwargs):
+    """
+    Sends a request through the host's session with default connect/read timeouts,
+    both capped at what is left of the request budget (see budget.py).
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    return session_for(url).request(method, url, timeout=budget.timeout(timeout), **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def close_all():
+    """Closes every pooled session, e.g. after forking."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+class JSONBlob:
+    """
+    A JSON string value given as byte fragments that need no escaping, such as
+    base64 data. json_body sends the fragments as they are instead of copying
+    them into every serialized request.
+    """
+
+    def __init__(self, *parts):
+        self.parts = [part.encode('ascii') if isinstance(part, str) else part for part in parts]
+
+
+class FragmentBody:
+    """
+    Read-only file over a list of byte strings, so a request body can be sent
+    without joining them. Has a length and is seekable, so requests sets
+    Content-Length and urllib3 can rewind it for a retry.
+    """
+
+    def __init__(self, fragments):
+        self._fragments = [memoryview(fragment) for fragment in fragments if fragment]
+        self._length = sum(len(fragment) for fragment in self._fragments)
+        self._position = 0
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        base = (0, self._position, self._length)[whence]
+        self._position = max(0, min(self._length, base + offset))
+        return self._position
+
+    def read(self, size=-1):
+        end = self._length if size is None or size < 0 else min(self._length, self._position + size)
+        pieces = []
+        start = 0
+        for fragment in self._fragments:
+            stop = start + len(fragment)
+            if stop > self._position and start < end:
+                pieces.append(fragment[max(0, self._position - start):end - start])
+            start = stop
+        self._position = end
+        return b''.join(pieces)
+
+
+def json_body(payload):
+    """
+    Serializes `payload` to a FragmentBody. JSONBlob values are left out of the
+    serialization and spliced in as their own fragments, so a large shared value
+    is referenced by each body rather than copied into it.
+    """
+    blobs = []
+    marker = f"blob{random.getrandbits(64):x}_"  # random, so payload text won't be mistaken for it
+
+    def swap(value):
+        if isinstance(value, JSONBlob):
+            blobs.append(value)
+            return f"\x00{marker}{len(blobs) - 1}\x00"
+        if isinstance(value, dict):
+            return {key: swap(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [swap(item) for item in value]
+        return value
+
+    text = json.dumps(swap(payload))
+    fragments = []
+    position = 0
+    for match in re.finditer(rf'\\u0000{marker}(\d+)\\u0000', text):
+        fragments.append(text[position:match.start()].encode())
+        fragments.extend(blobs[int(match.group(1))].parts)
+        position = match.end()
+    fragments.append(text[position:].encode())
+    return FragmentBody(fragments)
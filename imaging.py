@@ -0,0 +1,196 @@
+import base64
+import hashlib
+import io
+import logging
+import math
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# A perceptual hash with fewer set or clear bits than this comes from a flat, low-texture image.
+# Such hashes are near-identical for unrelated images, so they are not used
+PERCEPTUAL_HASH_MIN_BITS = 8
+
+
+def _open_upload(upload):
+    """
+    Uploads are bytes or a seekable file, such as a spooled request file,
+    so a large upload never has to be read into memory as a whole.
+    Returns a file positioned at the start.
+    """
+    if isinstance(upload, (bytes, bytearray, memoryview)):
+        return io.BytesIO(upload)
+    upload.seek(0)
+    return upload
+
+
+def upload_size(upload):
+    """Size in bytes of an upload given as bytes or a seekable file."""
+    if isinstance(upload, (bytes, bytearray, memoryview)):
+        return len(upload)
+    return upload.seek(0, io.SEEK_END)
+
+
+def content_hash(image_data):
+    """SHA-256 of the raw upload bytes."""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(image_data).hexdigest()
+    digest = hashlib.sha256()
+    stream = _open_upload(image_data)
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def perceptual_hash(image_data):
+    """
+    64-bit difference hash (dHash) of an image.
+    Robust to re-encoding, resizing and small colour changes.
+    Returns None when the bytes cannot be decoded as an image, or when the image
+    has too little texture for its hash to tell it apart from others.
+    """
+    from PIL import Image  # deferred, Pillow is slow to import and only needed once an upload arrives
+    try:
+        image = Image.open(_open_upload(image_data))
+        # Let the JPEG decoder downscale while decoding, we only need 9x8 pixels
+        image.draft('L', (64, 64))
+        pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.warning(f"Could not compute perceptual hash: {str(e)}")
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    if min(value.bit_count(), 64 - value.bit_count()) < PERCEPTUAL_HASH_MIN_BITS:
+        return None
+    return value
+
+
+FEATURE_DIM = 96
+FEATURE_GRID = 32  # side of the thumbnail the features are computed on
+BACKGROUND_DISTANCE = 24  # RGB distance from the background below which a pixel counts as background
+
+
+def image_features(image_data):
+    """
+    Compact CPU-only feature vector of an image for nearest-neighbour lookups.
+    The background is estimated per row from the pixels at the left and right edges,
+    and each pixel is weighted by how far its colour is from it, so the subject
+    rather than the sky or foliage behind it decides the vector. It holds a
+    square-rooted, softly binned 4x4x4 colour histogram of those weights and the
+    mean-centred 8x8 brightness layout of the subject's bounding box, folded so
+    mirror images match. Both halves weigh the same and the vector has unit length,
+    so the dot product of two vectors is their cosine similarity, near zero for
+    unrelated subjects. Components are in [-1/sqrt(2), 1/sqrt(2)].
+    Returns a list of FEATURE_DIM floats, or None when the bytes cannot be decoded.
+    """
+    from PIL import Image, ImageOps
+    grid = FEATURE_GRID
+    try:
+        image = Image.open(_open_upload(image_data))
+        image.draft('RGB', (2 * grid, 2 * grid))
+        image = ImageOps.exif_transpose(image).convert('RGB').resize((grid, grid), Image.BILINEAR)
+        pixels = list(image.getdata())
+        brightness = image.convert('L')
+    except Exception as e:
+        logger.warning(f"Could not compute image features: {str(e)}")
+        return None
+
+    colours = [0.0] * 64
+    columns, rows = [], []
+    for y in range(grid):
+        row = pixels[y * grid:(y + 1) * grid]
+        edge = row[:2] + row[-2:]
+        background = [sum(pixel[c] for pixel in edge) / len(edge) for c in range(3)]
+        for x, pixel in enumerate(row):
+            weight = math.dist(pixel, background) - BACKGROUND_DISTANCE
+            if weight <= 0:
+                continue
+            columns.append(x)
+            rows.append(y)
+            # Each channel is split between its two nearest of 4 levels, so a
+            # small change in lighting moves weight between bins gradually
+            bins = []
+            for value in pixel:
+                position = min(3.0, max(0.0, value / 64 - 0.5))
+                low = min(2, int(position))
+                bins.append(((low, 1 - (position - low)), (low + 1, position - low)))
+            for r, r_share in bins[0]:
+                for g, g_share in bins[1]:
+                    for b, b_share in bins[2]:
+                        colours[r << 4 | g << 2 | b] += weight * r_share * g_share * b_share
+
+    box = (min(columns), min(rows), max(columns) + 1, max(rows) + 1) if columns else (0, 0, grid, grid)
+    layout = list(brightness.crop(box).resize((8, 8), Image.BOX).getdata())
+    folded = [layout[row * 8 + col] + layout[row * 8 + 7 - col] for row in range(8) for col in range(4)]
+    mean = sum(folded) / len(folded)
+
+    def unit(values):
+        norm = math.sqrt(sum(value * value for value in values)) or 1
+        # Both halves weigh the same in the combined vector
+        return [value / norm / math.sqrt(2) for value in values]
+
+    return unit([math.sqrt(weight) for weight in colours]) + unit([value - mean for value in folded])
+
+
+PreparedImage = namedtuple('PreparedImage', ['data', 'mime_type', 'encoded'])
+
+def sniff_mime_type(image_data):
+    """Guesses the MIME type from magic bytes, defaulting to JPEG."""
+    if image_data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if image_data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+
+def prepare_image(image_data, max_edge=1024, quality=85):
+    """
+    Shrinks an upload to what the vision models need and base64 encodes it once.
+    `encoded` is ASCII bytes so request bodies can share it (see http_client.JSONBlob).
+    The image is rotated per its EXIF orientation, EXIF and other metadata are
+    dropped, the longest edge is capped at `max_edge` pixels (0 keeps the size)
+    and the result is re-encoded as JPEG at `quality`.
+    Bytes Pillow cannot decode are passed through with a sniffed MIME type.
+    """
+    from PIL import Image, ImageOps
+    try:
+        image = Image.open(_open_upload(image_data))
+        source_format = image.format
+        if max_edge:
+            # JPEG can decode straight to a smaller scale, saving most of the decode work
+            image.draft('RGB', (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        if max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality)
+        data = output.getvalue()
+        logger.info(
+            f"Prepared {source_format} upload: {upload_size(image_data)} -> {len(data)} bytes, {image.size[0]}x{image.size[1]}"
+        )
+        mime_type = 'image/jpeg'
+    except Exception as e:
+        logger.warning(f"Could not preprocess image, sending it unchanged: {str(e)}")
+        data = _open_upload(image_data).read() if not isinstance(image_data, bytes) else image_data
+        mime_type = sniff_mime_type(data)
+
+    return PreparedImage(data, mime_type, base64.b64encode(data))
@@ -0,0 +1,214 @@
+import ast
+import json
+import logging
+
+import http_client
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Response dialects
+GEMINI = 'gemini'  # generateContent / streamGenerateContent
+CHAT = 'chat'  # OpenAI-style chat completions (Mistral, Together)
+
+
+def object_schema(**properties):
+    """
+    JSON schema for an object whose properties are all required and kept in the
+    given order, so the fields we need first are generated first.
+    """
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(properties),
+        'propertyOrdering': list(properties),
+    }
+
+
+STRING = {'type': 'string'}
+STRING_LIST = {'type': 'array', 'items': STRING}
+
+
+class IncrementalJSONParser:
+    """
+    Parses the first JSON object in text that arrives in pieces.
+    `on_field(name, value)` is called for each top-level member as soon as its
+    value is complete, so e.g. `species` can be used before `description` has
+    finished generating. Text around the object, such as code fences, is ignored.
+    """
+
+    def __init__(self, on_field=None):
+        self.on_field = on_field
+        self.text = ''
+        self.fields = {}
+        self.done = False
+        self._position = 0
+        self._start = None  # index of the opening brace
+        self._member_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        text = self.text
+        for i in range(self._position, len(text)):
+            if self.done:
+                break
+            char = text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                if self._start is not None:
+                    self._in_string = True
+            elif char in '{[':
+                if self._start is None and char == '{':
+                    self._start = self._member_start = i + 1
+                self._depth += self._start is not None
+            elif char in '}]' and self._start is not None:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._member_done(text[self._member_start:i])
+                    self.done = True
+            elif char == ',' and self._depth == 1:
+                self._member_done(text[self._member_start:i])
+                self._member_start = i + 1
+        self._position = len(text)
+
+    def _member_done(self, member):
+        if not member.strip():
+            return
+        try:
+            parsed = json.loads('{' + member + '}')
+        except ValueError:
+            return  # not strict JSON, left to the final parse
+        for name, value in parsed.items():
+            self.fields[name] = value
+            if self.on_field:
+                self.on_field(name, value)
+
+    def result(self):
+        """The complete object. Raises ValueError if the text holds none."""
+        return parse_json_object(self.text)
+
+
+def parse_json_object(text):
+    """
+    Returns the first JSON object in `text`, which may be wrapped in prose or code fences.
+    Python-style dicts with single quotes are accepted as a fallback; apostrophes in
+    values such as "Cooper's Hawk" survive either way.
+    """
+    start = text.find('{')
+    if start < 0:
+        raise ValueError('No JSON object in model response')
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text, start)
+    except ValueError:
+        end = text.rfind('}') + 1
+        try:
+            value = ast.literal_eval(text[start:end])
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            raise ValueError('Model response is not valid JSON') from None
+    if not isinstance(value, dict):
+        raise ValueError('Model response is not a JSON object')
+    return value
+
+
+def _sse_data(response):
+    """Yields the data payload of each server-sent event in a streamed response."""
+    data = []
+    for line in response.iter_lines():
+        line = line.decode('utf-8')
+        if not line:
+            if data:
+                yield '\n'.join(data)
+                data = []
+        elif line.startswith('data:'):
+            data.append(line[5:].lstrip())
+    if data:
+        yield '\n'.join(data)
+
+
+def _gemini_text(payload):
+    candidates = payload.get('candidates') or [{}]
+    parts = (candidates[0].get('content') or {}).get('parts') or []
+    return ''.join(part.get('text', '') for part in parts)
+
+
+def _chat_text(payload, stream):
+    choice = (payload.get('choices') or [{}])[0]
+    message = choice.get('delta' if stream else 'message') or {}
+    return message.get('content') or ''
+
+
+def complete_json(dialect, url, payload, name, headers=None, timeout=None, stream=False, on_field=None,
+                  check=None):
+    """
+    Sends one model request and returns the JSON object in its answer.
+    With `stream` the answer is read as server-sent events and parsed as it
+    arrives, calling `on_field(name, value)` for each completed top-level field.
+    `check(response)` runs before the body is read and should raise for a failed call.
+    `name` labels the parse in latency metrics.
+    """
+    headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+    response = http_client.post(url, data=http_client.json_body(payload), headers=headers, timeout=timeout,
+                                stream=stream)
+    with response:
+        if check:
+            check(response)
+        parser = IncrementalJSONParser(on_field)
+        if stream:
+            for event in _sse_data(response):
+                if event == '[DONE]':
+                    break
+                chunk = json.loads(event)
+                parser.feed(_gemini_text(chunk) if dialect == GEMINI else _chat_text(chunk, stream=True))
+                if parser.done:
+                    # Nothing after the object is needed, stop paying for the read
+                    break
+        else:
+            body = response.json()
+            parser.feed(_gemini_text(body) if dialect == GEMINI else _chat_text(body, stream=False))
+
+    with timed('json_extract', provider=name) as timer:
+        try:
+            return parser.result()
+        except ValueError:
+            timer.status = 'empty'
+            logger.warning(f"Unparseable answer from {name}: {parser.text[:200]!r}")
+            raise
+
+
+def gemini_url(base, model, api_key, stream=False):
+    method = 'streamGenerateContent?alt=sse&' if stream else 'generateContent?'
+    return f"{base}/v1beta/models/{model}:{method}key={api_key}"
+
+
+def gemini_payload(parts, schema=None, structured=True):
+    """generateContent body; `structured` asks for JSON output, constrained to `schema` when given."""
+    data = {"contents": [{"parts": parts}]}
+    if structured:
+        data["generationConfig"] = {"responseMimeType": "application/json"}
+        if schema:
+            data["generationConfig"]["responseSchema"] = schema
+    return data
+
+
+def chat_payload(model, content, schema=None, structured=True, stream=False, **options):
+    """
+    Chat completions body with one user message. `structured` turns on JSON mode;
+    `schema` is passed along for providers that accept one with it.
+    """
+    data = dict({"model": model, "messages": [{"role": "user", "content": content}]}, **options)
+    if structured:
+        data["response_format"] = {"type": "json_object"}
+        if schema:
+            data["response_format"]["schema"] = schema
+    if stream:
+        data["stream"] = True
+    return data
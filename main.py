@@ -1,26 +1,332 @@
 import base64
-from flask import Flask, request, jsonify
+import contextvars
+import functools
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import click
+from flask import Flask, Request, Response, g, redirect, request, jsonify
 import logging
+import queue
 import sys
+import tempfile
+import threading
+import uuid
+import zipfile
+from urllib.parse import quote, urlencode
 from flask_cors import CORS  # Import CORS
 import os
-import requests
+import budget
+import http_client
 import json
-from bs4 import BeautifulSoup
-from dotenv import load_dotenv
+from bing import extract_image_urls
+from cache import ResultCache, TTLCache
+from classifier import FeatureIndex, NearestNeighbourClassifier
+from imaging import content_hash, perceptual_hash, prepare_image
+from taxonomy import get_index, species_key
+import llm
+import metrics
+from admission import AdmissionController, Overloaded
+from metrics import submit, timed
+from health import CLOSED, OPEN, ProviderHealth
+from manifest import SpeciesManifest, write_manifest
+from ratelimit import BATCH, PREWARM, RateLimiter, RateLimitExceeded, priority
 
-# Load environment variables
-load_dotenv()
+# Load environment variables from a .env file. Serverless deployments set them
+# directly, have no .env and skip importing dotenv on every cold start.
+if any(os.path.exists(os.path.join(folder, '.env')) for folder in ('.', os.path.dirname(os.path.abspath(__file__)))):
+    from dotenv import load_dotenv
+    load_dotenv()
+# DEBUG also logs every model answer and upstream connection
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=LOG_LEVEL,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 logger = logging.getLogger(__name__)
+
+# Upload limits, larger requests are refused with a 413 before their body is read
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+BATCH_MAX_UPLOAD_BYTES = int(os.getenv('BATCH_MAX_UPLOAD_BYTES', str(200 * 1024 * 1024)))
+UPLOAD_SPOOL_BYTES = int(os.getenv('UPLOAD_SPOOL_BYTES', str(1024 * 1024)))  # larger files are spooled to disk
+
+
+class UploadRequest(Request):
+    """Request with per-endpoint upload limits that spools large files to a temporary file."""
+
+    @property
+    def max_content_length(self):
+        return BATCH_MAX_UPLOAD_BYTES if self.endpoint == 'identify_bird_batch' else MAX_UPLOAD_BYTES
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode='rb+')
+
+
 app = Flask(__name__)
-CORS(app, origins=["https://9000-idx-find-the-bird-1740898861496.cluster-3g4scxt2njdd6uovkqyfcabgo6.cloudworkstations.dev/","https://know-your-bird-frontend.vercel.app/","*",'https://know-your-bird-frontend.vercel.app/'])
+app.request_class = UploadRequest
+CORS(app, expose_headers=['Server-Timing'], origins=["https://9000-idx-find-the-bird-1740898861496.cluster-3g4scxt2njdd6uovkqyfcabgo6.cloudworkstations.dev/","https://know-your-bird-frontend.vercel.app/","*",'https://know-your-bird-frontend.vercel.app/'])
 # Configure Google Gemini API
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# Provider endpoints, overridable to point the app at local stubs (see benchmarks/)
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', "https://generativelanguage.googleapis.com")
+MISTRAL_API_BASE = os.getenv('MISTRAL_API_BASE', "https://api.mistral.ai")
+TOGETHER_API_BASE = os.getenv('TOGETHER_API_BASE', "https://api.together.xyz")
+
+GEMINI_MODEL = 'gemini-2.0-flash'
+# Ask providers for native JSON output, and read their answers as they stream in
+STRUCTURED_OUTPUT = os.getenv('STRUCTURED_OUTPUT', '1') == '1'
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+# Field order is generation order, the voting key comes first
+CLASSIFICATION_SCHEMA = llm.object_schema(species=llm.STRING, reason=llm.STRING)
+AGGREGATION_SCHEMA = llm.object_schema(species=llm.STRING, description=llm.STRING, variation_species=llm.STRING_LIST)
+DESCRIPTION_SCHEMA = llm.object_schema(description=llm.STRING, variation_species=llm.STRING_LIST)
+
+# Provider fan-out settings
+PROVIDER_TIMEOUT = float(os.getenv('PROVIDER_TIMEOUT', '30'))  # seconds per provider call
+FANOUT_DEADLINE = float(os.getenv('FANOUT_DEADLINE', '45'))  # seconds for the whole fan-out
+FANOUT_QUORUM = int(os.getenv('FANOUT_QUORUM', '2'))  # agreeing providers needed to return early, 0 waits for all
+CONSENSUS_MIN_VOTES = int(os.getenv('CONSENSUS_MIN_VOTES', '2'))  # majority size that skips the image aggregation call
+# Hedge a provider call once it runs past the provider's recent p95, but never sooner than this
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', '1') == '1'
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '2'))
+provider_health = {
+    name: ProviderHealth(
+        name,
+        window=int(os.getenv('HEALTH_WINDOW', '50')),
+        failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+        error_rate_threshold=float(os.getenv('CIRCUIT_ERROR_RATE', '0.5')),
+        cooldown=float(os.getenv('CIRCUIT_COOLDOWN', '30')),
+        trial_timeout=2 * PROVIDER_TIMEOUT  # a trial call that never reports back is given up after this
+    )
+    for name in ('gemini', 'mistral', 'llama')
+}
+# Per-minute request quotas per API key, 0 means unlimited.
+# With RATE_LIMIT_DB set the buckets are shared by every gunicorn worker.
+rate_limiters = {
+    quota: RateLimiter(quota, per_minute=int(os.getenv(f'{quota.upper()}_RPM', '0')), db_path=os.getenv('RATE_LIMIT_DB'))
+    for quota in ('gemini', 'mistral', 'together')
+}
+PROVIDER_QUOTAS = {'gemini': 'gemini', 'mistral': 'mistral', 'llama': 'together'}
+RATE_LIMIT_PENALTY = float(os.getenv('RATE_LIMIT_PENALTY', '10'))  # seconds to pause a quota after a 429 without Retry-After
+# A limited quota pauses itself on a 429 (see check_response), unlimited ones keep the HTTP retries
+for quota, api_base in {'gemini': GEMINI_API_BASE, 'mistral': MISTRAL_API_BASE, 'together': TOGETHER_API_BASE}.items():
+    if rate_limiters[quota].rate:
+        http_client.rate_limited_host(api_base)
+# Image lookup settings
+WIKIPEDIA_API_URL = os.getenv('WIKIPEDIA_API_URL', "https://en.wikipedia.org/w/api.php")
+COMMONS_API_URL = os.getenv('COMMONS_API_URL', "https://commons.wikimedia.org/w/api.php")
+BING_BASE_URL = os.getenv('BING_BASE_URL', "https://www.bing.com")
+WIKI_TITLES_PER_QUERY = 50  # MediaWiki limit for multi-title queries
+BING_CHUNK_SIZE = 16 * 1024
+LOOKUP_WORKERS = int(os.getenv('LOOKUP_WORKERS', '16'))
+lookup_executor = ThreadPoolExecutor(
+    max_workers=LOOKUP_WORKERS,
+    thread_name_prefix='lookup'
+)
+# Browser and CDN caching of /species/<name>/images, in seconds
+SPECIES_IMAGES_MAX_AGE = int(os.getenv('SPECIES_IMAGES_MAX_AGE', str(24 * 3600)))
+SPECIES_IMAGES_EDGE_MAX_AGE = int(os.getenv('SPECIES_IMAGES_EDGE_MAX_AGE', str(7 * 24 * 3600)))
+SPECIES_IMAGES_EMPTY_MAX_AGE = 600  # an empty answer may just be a failed lookup, retry soon
+SPECIES_IMAGES_MAX_LIMIT = 12
+
+# Admission control for the identification endpoints: requests beyond the in-flight
+# limit wait in a bounded queue for at most ADMISSION_MAX_WAIT seconds, then get a 503
+admission = AdmissionController(
+    max_in_flight=int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '8')),  # 0 disables admission control
+    max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', '16')),
+    max_wait=float(os.getenv('ADMISSION_MAX_WAIT', '10'))
+)
+# Sized so every identification that can run at once, admitted requests, batch items and
+# jobs, gets its three provider calls plus a hedge without queueing: a queued call would
+# spend its fan-out deadline waiting for a thread
+IDENTIFICATIONS_IN_FLIGHT = (
+    (admission.max_in_flight or 8) + int(os.getenv('BATCH_CONCURRENCY', '4')) + int(os.getenv('JOB_WORKERS', '4'))
+)
+PROVIDER_WORKERS = int(os.getenv('PROVIDER_WORKERS', str(4 * IDENTIFICATIONS_IN_FLIGHT)))
+provider_executor = ThreadPoolExecutor(
+    max_workers=PROVIDER_WORKERS,
+    thread_name_prefix='provider'
+)
+
+# Latency budget of an interactive identification, in seconds from the request's arrival,
+# so the frontend can rely on an answer in time. 0 disables it. Optional stages are skipped
+# when less than their minimum is left and the answer lists them under `omitted`.
+REQUEST_BUDGET = float(os.getenv('REQUEST_BUDGET', '25'))
+AGGREGATION_MIN_BUDGET = float(os.getenv('AGGREGATION_MIN_BUDGET', '4'))  # else the plurality answer is used
+DESCRIPTION_MIN_BUDGET = float(os.getenv('DESCRIPTION_MIN_BUDGET', '3'))  # uncached descriptions only
+IMAGES_MIN_BUDGET = float(os.getenv('IMAGES_MIN_BUDGET', '1'))
+# Runs the aggregation and description calls the request thread stops waiting for at its deadline.
+# Kept apart from the provider pool, where slow providers left behind by a quorum would hold them up.
+BUDGET_WORKERS = int(os.getenv('BUDGET_WORKERS', '16'))
+budget_executor = ThreadPoolExecutor(
+    max_workers=BUDGET_WORKERS,
+    thread_name_prefix='budget'
+)
+# Every thread that may call one host at once gets a kept-alive connection: beyond the
+# pool urllib3 discards connections after use, and each new one costs a TLS handshake
+http_client.size_pools(PROVIDER_WORKERS + BUDGET_WORKERS + LOOKUP_WORKERS + IDENTIFICATIONS_IN_FLIGHT)
+
+# Seconds between keep-alive lines on an idle /identify-bird/stream response
+STREAM_HEARTBEAT = float(os.getenv('STREAM_HEARTBEAT', '15'))
+
+# Batch identification settings
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '200'))
+BATCH_MAX_ENTRY_BYTES = int(os.getenv('BATCH_MAX_ENTRY_BYTES', str(20 * 1024 * 1024)))
+# Decompressed size of all images in one archive, a small zip can expand to gigabytes
+BATCH_MAX_ARCHIVE_BYTES = int(os.getenv('BATCH_MAX_ARCHIVE_BYTES', str(256 * 1024 * 1024)))
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff')
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('BATCH_CONCURRENCY', '4')),  # images in flight across all batches
+    thread_name_prefix='batch'
+)
+
+# Asynchronous jobs
+JOB_TTL = float(os.getenv('JOB_TTL', '3600'))  # seconds a job and its result are kept
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', '25'))  # longest long-poll, keep it under the proxy timeout
+JOB_POLL_INTERVAL = 0.5
+job_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('JOB_WORKERS', '4')),
+    thread_name_prefix='job'
+)
+# Jobs queued or running at once, each holding its upload in memory; more get a 503
+job_admission = AdmissionController(max_in_flight=int(os.getenv('JOB_MAX_PENDING', '16')))
+# With JOB_STORE_DB set every gunicorn worker can answer for any job, so skip the
+# in-memory tier, which would keep serving a stale status for jobs run elsewhere
+job_store = TTLCache(
+    'jobs',
+    max_entries=0 if os.getenv('JOB_STORE_DB') else int(os.getenv('JOB_STORE_SIZE', '10000')),
+    ttl=JOB_TTL,
+    db_path=os.getenv('JOB_STORE_DB')
+)
+job_events = {}  # job id -> Event set when a job run by this process finishes
+
+# Species -> image URL cache shared by get_image_urls and fetch_species_images
+image_cache = TTLCache(
+    'images',
+    max_entries=int(os.getenv('IMAGE_CACHE_SIZE', '2048')),
+    ttl=float(os.getenv('IMAGE_CACHE_TTL', str(7 * 24 * 3600))),
+    negative_ttl=float(os.getenv('IMAGE_CACHE_NEGATIVE_TTL', '600')),
+    db_path=os.getenv('IMAGE_CACHE_DB')  # unset keeps the cache in memory only
+)
+
+# Species -> description and variation species, independent of the photo
+content_cache = TTLCache(
+    'content',
+    max_entries=int(os.getenv('CONTENT_CACHE_SIZE', '4096')),
+    ttl=float(os.getenv('CONTENT_CACHE_TTL', str(30 * 24 * 3600))),
+    db_path=os.getenv('CONTENT_CACHE_DB')
+)
+
+# Prebuilt species -> images manifest from `flask prewarm-images`, consulted before any lookup
+species_manifest = SpeciesManifest(os.getenv('SPECIES_MANIFEST')) if os.getenv('SPECIES_MANIFEST') else None
+
+# Upload preprocessing before the image is sent to the vision models
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', '1024'))  # pixels, 0 keeps the original size
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+
+# Upload -> identification result cache for repeat photos
+result_cache = ResultCache(
+    max_entries=int(os.getenv('RESULT_CACHE_SIZE', '512')),
+    max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+    max_distance=int(os.getenv('RESULT_CACHE_MAX_DISTANCE', '4')),  # perceptual hash bits, -1 disables
+    ttl=float(os.getenv('RESULT_CACHE_TTL', str(24 * 3600)))
+)
+
+# Local first tier: photos close to past consensus answers are identified without the
+# providers. Unset CLASSIFIER_INDEX disables it; large indexes need numpy.
+first_tier = NearestNeighbourClassifier(
+    FeatureIndex(os.getenv('CLASSIFIER_INDEX')),
+    k=int(os.getenv('CLASSIFIER_NEIGHBOURS', '5')),
+    # Defaults from benchmarks/classifier_index.py, where no photo of an unknown species got an answer
+    min_similarity=float(os.getenv('CLASSIFIER_MIN_SIMILARITY', '0.96')),  # cosine similarity of features
+    min_confidence=float(os.getenv('CLASSIFIER_MIN_CONFIDENCE', '0.8')),  # share of the neighbours' similarity
+    min_votes=int(os.getenv('CLASSIFIER_MIN_VOTES', '3')),
+    duplicate_similarity=float(os.getenv('CLASSIFIER_DUPLICATE_SIMILARITY', '0.998')),  # re-uploads, not new shots
+    python_max_entries=int(os.getenv('CLASSIFIER_PYTHON_MAX_ENTRIES', '10000'))  # without numpy
+) if os.getenv('CLASSIFIER_INDEX') else None
+
+# Metrics served on /metrics
+request_seconds = metrics.Histogram(
+    'bird_request_duration_seconds',
+    'End-to-end request latency.',
+    ['endpoint', 'status']
+)
+CACHES = {'images': image_cache, 'content': content_cache, 'results': result_cache}
+if species_manifest is not None:
+    CACHES['manifest'] = species_manifest
+if first_tier is not None:
+    CACHES['classifier'] = first_tier
+metrics.CallbackMetric(
+    'bird_cache_events_total',
+    'Cache lookups by outcome.',
+    ['cache', 'event'],
+    lambda: {
+        (name, event): value
+        for name, cache in CACHES.items()
+        for event, value in cache.stats().items()
+        if event not in ('entries', 'bytes', 'hit_ratio')
+    },
+    type='counter'
+)
+hedged_calls = metrics.Counter('bird_provider_hedged_total', 'Hedged duplicate provider calls.', ['provider'])
+skipped_calls = metrics.Counter('bird_provider_skipped_total', 'Provider calls skipped by an open circuit.', ['provider'])
+omitted_stages = metrics.Counter(
+    'bird_omitted_stages_total',
+    'Optional stages skipped or cut short by the request budget.',
+    ['stage']
+)
+metrics.CallbackMetric(
+    'bird_provider_circuit_open',
+    '1 while the provider circuit breaker is open.',
+    ['provider'],
+    lambda: {(name,): int(health.state == OPEN) for name, health in provider_health.items()}
+)
+metrics.CallbackMetric(
+    'bird_admission_requests',
+    'Identification requests running or waiting for admission.',
+    ['state'],
+    lambda: {(state,): admission.stats()[state] for state in ('in_flight', 'queued')}
+)
+metrics.CallbackMetric(
+    'bird_admission_decisions_total',
+    'Identification requests admitted or shed, by reason.',
+    ['outcome'],
+    lambda: {
+        (outcome,): value
+        for outcome, value in admission.stats().items()
+        if outcome not in ('in_flight', 'queued')
+    },
+    type='counter'
+)
+metrics.CallbackMetric(
+    'bird_rate_limit_queue_depth',
+    'Calls waiting for provider quota.',
+    ['quota', 'priority'],
+    lambda: {
+        (quota, level): depth
+        for quota, limiter in rate_limiters.items()
+        for level, depth in limiter.queue_depth().items()
+    }
+)
+metrics.CallbackMetric(
+    'bird_rate_limit_calls_total',
+    'Quota requests by outcome.',
+    ['quota', 'outcome'],
+    lambda: {
+        key: value
+        for quota, limiter in rate_limiters.items()
+        for key, value in (((quota, 'granted'), limiter.granted), ((quota, 'rejected'), limiter.rejected))
+    },
+    type='counter'
+)
+metrics.CallbackMetric(
+    'bird_cache_entries',
+    'Entries held in memory by each cache.',
+    ['cache'],
+    lambda: {(name,): cache.stats()['entries'] for name, cache in CACHES.items()}
+)
 
 
 
@@ -30,153 +336,780 @@ def encode_image(image_file):
 
 
 
+@app.before_request
+def start_timing():
+    g.request_started = time.perf_counter()
+    g.request_arrived = time.monotonic()  # the request budget counts from here
+    metrics.start_request_timing()
+
+@app.after_request
+def add_server_timing(response):
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    request_seconds.observe(elapsed, endpoint=request.endpoint or 'unknown', status=str(response.status_code))
+    header = metrics.server_timing_header(total=elapsed)
+    if header:
+        response.headers['Server-Timing'] = header
+    return response
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    limit = request.max_content_length // (1024 * 1024)
+    return jsonify({'error': 'Upload too large', 'message': f'Uploads are limited to {limit} MB.'}), 413
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/test',methods=['GET'])
 def test():
     return "Hello World"
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({name: cache.stats() for name, cache in CACHES.items()})
+
+@app.route('/providers/health', methods=['GET'])
+def providers_health():
+    return jsonify({name: health.snapshot() for name, health in provider_health.items()})
+
+def admit_request():
+    """
+    Waits for admission. Returns (admitted_at, None) once admitted, or
+    (None, response) with a 503 and Retry-After when the request is shed.
+    """
+    with timed('admission_queue') as timer:
+        try:
+            return admission.acquire(), None
+        except Overloaded as e:
+            timer.status = 'shed'
+            logger.warning(f"Shedding {request.path}: {str(e)}")
+            response = jsonify({'error': 'Server busy', 'message': 'Too many identifications in progress, please try again shortly.'})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(e.retry_after)
+            return None, response
+
+
+def admission_controlled(view):
+    """Runs the view only once admission control lets the request in."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admitted_at, rejection = admit_request()
+        if rejection is not None:
+            return rejection
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.release(admitted_at)
+    return wrapper
+
+
 @app.route('/identify-bird', methods=['POST'])
+@admission_controlled
 def identify_bird():
     # Check if image is in the request
     if 'image' not in request.files:
-      print('no image')
+      logger.info('Rejected /identify-bird request without an image')
       return jsonify({'error': 'No image provided', 'message': 'Please select an image of a bird to identify.'}), 400
         
     
+    # ?images=0 answers with species, votes and description only; the client
+    # then fetches the cacheable /species/<name>/images links it is given
+    include_images = request.args.get('images', 'true').lower() not in ('0', 'false', 'no')
+
     image_file = request.files['image']
     try:
-        # Process image with Gemini API
-        image_data = image_file.read()
-        encoded_image = encode_image(image_data)
-        multi_response = multiple_responses(encoded_image)
+        # Hashing and decoding read the spooled upload in place, it is never held as one bytes object
+        with budget.request_budget(REQUEST_BUDGET, started=g.request_arrived):
+            return jsonify(identify_cached(image_file.stream, include_images=include_images))
+
+    except budget.BudgetExhausted:
+        return jsonify({'error': 'Identification timed out', 'message': 'No answer in time, please try again.'}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/species/<name>/images', methods=['GET'])
+def species_images(name):
+    """
+    Image URLs for one species, with ETag and Cache-Control headers so browsers
+    and the CDN can serve repeats. Aliases redirect to the canonical name so
+    they share one edge cache entry.
+    """
+    canonical = get_index().lookup(name)
+    if canonical and canonical != name:
+        return redirect(species_images_url(canonical, **request.args), code=301)
+
+    limit = max(1, min(request.args.get('limit', 6, type=int), SPECIES_IMAGES_MAX_LIMIT))
+    try:
+        images = get_image_urls(name, limit)
+    except Exception as e:
+        logger.warning(f"Image lookup for '{name}' failed: {str(e)}")
+        response = jsonify({'error': 'Image lookup failed', 'message': 'Please try again shortly.'})
+        response.status_code = 502
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    body = json.dumps({'species': name, 'images': images}, separators=(',', ':'))
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha256(body.encode()).hexdigest()[:32])
+    if images:
+        response.headers['Cache-Control'] = (
+            f"public, max-age={SPECIES_IMAGES_MAX_AGE}, s-maxage={SPECIES_IMAGES_EDGE_MAX_AGE}, "
+            f"stale-while-revalidate={SPECIES_IMAGES_MAX_AGE}"
+        )
+    else:
+        response.headers['Cache-Control'] = f"public, max-age={SPECIES_IMAGES_EMPTY_MAX_AGE}"
+    # Answers 304 when If-None-Match matches
+    return response.make_conditional(request)
+
+
+def species_images_url(species, **params):
+    url = f"/species/{quote(species, safe='')}/images"
+    return f"{url}?{urlencode(params)}" if params else url
+
+
+@app.route('/identify-bird/stream', methods=['POST'])
+def identify_bird_stream():
+    """
+    Streaming variant of /identify-bird that sends each stage's output as soon as it is ready.
+    Server-sent events by default, newline-delimited JSON with ?format=ndjson.
+    Events: vote, species, description, species_images, variation_images, then result or error.
+    """
+    if 'image' not in request.files:
+      return jsonify({'error': 'No image provided', 'message': 'Please select an image of a bird to identify.'}), 400
+
+    # The upload has to be read while the request context is still alive
+    image_data = request.files['image'].read()
+    arrived = g.request_arrived
+    ndjson = request.args.get('format') == 'ndjson'
+    events = queue.Queue()
+
+    # The work outlives this view, so the admission slot is released by the worker thread
+    admitted_at, rejection = admit_request()
+    if rejection is not None:
+        return rejection
+
+    def emit(event, data):
+        events.put((event, data))
+
+    def run():
+        try:
+            with budget.request_budget(REQUEST_BUDGET, started=arrived):
+                emit('result', identify_cached(image_data, emit=emit))
+        except budget.BudgetExhausted:
+            emit('error', {'error': 'Identification timed out'})
+        except Exception as e:
+            emit('error', {'error': str(e)})
+        finally:
+            admission.release(admitted_at)
+            events.put(None)
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run,), name='identify-stream', daemon=True).start()
+
+    def generate():
+        while True:
+            try:
+                item = events.get(timeout=STREAM_HEARTBEAT)
+            except queue.Empty:
+                # Keeps proxies from closing an idle connection while the models think
+                yield "\n" if ndjson else ": keep-alive\n\n"
+                continue
+            if item is None:
+                return
+            event, data = item
+            if ndjson:
+                yield json.dumps({'event': event, 'data': data}) + "\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(
+        generate(),
+        mimetype='application/x-ndjson' if ndjson else 'text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/identify-bird/batch', methods=['POST'])
+def identify_bird_batch():
+    """
+    Identifies many photos in one request.
+    Accepts several `images` files, an `archive` zip of images, or both.
+    Items run on a bounded worker pool and share the species caches, so a
+    species seen earlier in the batch costs no further lookups.
+    """
+    try:
+        items = [(image.filename, image.read()) for image in request.files.getlist('images')]
+        if 'archive' in request.files:
+            items.extend(read_zip_images(request.files['archive']))
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'Invalid archive', 'message': 'The archive must be a zip file of images.'}), 400
+    except ValueError as e:
+        return jsonify({'error': 'Archive too large', 'message': str(e)}), 413
+
+    if not items:
+        return jsonify({'error': 'No image provided', 'message': 'Please select images of birds to identify.'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': 'Too many images', 'message': f'A batch can hold at most {BATCH_MAX_ITEMS} images.'}), 413
+
+    # Batch items queue behind interactive requests for provider quota
+    with priority(BATCH):
+        futures = [submit(batch_executor, identify_cached, image_data) for _, image_data in items]
+    results = []
+    for (filename, _), future in zip(items, futures):
+        try:
+            results.append({'filename': filename, 'result': future.result()})
+        except Exception as e:
+            results.append({'filename': filename, 'error': str(e)})
+
+    failed = sum(1 for item in results if 'error' in item)
+    return jsonify({'count': len(results), 'failed': failed, 'results': results})
+
+
+def read_zip_images(archive):
+    """
+    Returns (filename, bytes) for every image file in an uploaded zip.
+    Raises ValueError when the images would decompress to more than BATCH_MAX_ARCHIVE_BYTES.
+    """
+    images = []
+    total = 0
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or not name or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+            if os.path.splitext(name)[1].lower() not in BATCH_IMAGE_EXTENSIONS:
+                continue
+            if info.file_size > BATCH_MAX_ENTRY_BYTES:
+                logger.warning(f"Skipping oversized archive entry '{info.filename}'")
+                continue
+            # Checked before reading; zipfile never decompresses past an entry's declared size
+            total += info.file_size
+            if total > BATCH_MAX_ARCHIVE_BYTES:
+                raise ValueError(f'The images in an archive can take at most {BATCH_MAX_ARCHIVE_BYTES // (1024 * 1024)} MB uncompressed.')
+            images.append((info.filename, zf.read(info)))
+            if len(images) > BATCH_MAX_ITEMS:
+                break
+    return images
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queues an identification and returns its job id straight away.
+    Poll GET /jobs/<job_id> for the result.
+    """
+    if 'image' not in request.files:
+      return jsonify({'error': 'No image provided', 'message': 'Please select an image of a bird to identify.'}), 400
+
+    try:
+        accepted_at = job_admission.acquire()
+    except Overloaded as e:
+        logger.warning(f"Shedding {request.path}: {str(e)}")
+        response = jsonify({'error': 'Server busy', 'message': 'Too many jobs waiting, please try again shortly.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    image_data = request.files['image'].read()
+    job_id = uuid.uuid4().hex
+    job = {'job_id': job_id, 'status': 'queued', 'created_at': time.time()}
+    job_store.set(job_id, job, ttl=JOB_TTL)
+    job_events[job_id] = threading.Event()
+    submit(job_executor, run_job, job_id, image_data, accepted_at)
+
+    return jsonify(dict(job, status_url=f"/jobs/{job_id}")), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Returns a job's status, and its result once finished.
+    With ?wait=<seconds> the call blocks until the job finishes or the wait runs out.
+    """
+    wait_seconds = min(request.args.get('wait', 0, type=float), JOB_MAX_WAIT)
+    expires_at = time.monotonic() + wait_seconds
+
+    while True:
+        found, job = job_store.get(job_id)
+        if not found:
+            return jsonify({'error': 'Job not found', 'message': 'The job id is unknown or its result has expired.'}), 404
+        remaining = expires_at - time.monotonic()
+        if job['status'] in ('done', 'failed') or remaining <= 0:
+            return jsonify(job)
+
+        event = job_events.get(job_id)
+        if event is not None:
+            event.wait(remaining)
+        else:
+            # Job owned by another worker process, poll the shared store
+            time.sleep(min(JOB_POLL_INTERVAL, remaining))
+
+
+def run_job(job_id, image_data, accepted_at):
+    """Runs a queued job on the job pool and records the outcome."""
+    found, job = job_store.get(job_id)
+    job = dict(job) if found else {'job_id': job_id, 'created_at': time.time()}
+    job_store.set(job_id, dict(job, status='running'), ttl=JOB_TTL)
+    try:
+        job.update(status='done', result=identify_cached(image_data))
+    except Exception as e:
+        job.update(status='failed', error=str(e))
+    finally:
+        job_admission.release(accepted_at)
+    job['finished_at'] = time.time()
+    job_store.set(job_id, job, ttl=JOB_TTL)
+
+    event = job_events.pop(job_id, None)
+    if event is not None:
+        event.set()
+
+
+def identify_cached(image_data, emit=None, include_images=True):
+    """
+    Identifies an upload, serving repeat or near-identical photos from the result cache.
+    Without `include_images` the species image lookups are skipped and the result
+    links to /species/<name>/images instead.
+    `partial` and `omitted` in the result tell which stages were cut or failed.
+    """
+    # Its own omission scope, so stages omitted by jobs and batch items, which run
+    # without a request budget, also keep their partial results out of the cache
+    with budget.request_budget(None):
+        upload_hash = content_hash(image_data)
+        upload_phash = perceptual_hash(image_data)
+        result = result_cache.get(upload_hash, upload_phash)
+        if result is None:
+            result = run_identification(image_data, emit=emit, include_images=include_images)
+            # Partial answers are not kept, the next request may have time for the full one
+            if not budget.omitted():
+                result_cache.set(upload_hash, upload_phash, result)
+        elif include_images and 'species_images' not in result:
+            # Cached by an images-free request, complete it from the image cache
+            species_images, variation_images = resolve_species_images(result['species'], result['variation_species'])
+            result = dict(result, species_images=species_images, variation_images=variation_images)
+            if not budget.omitted():
+                result_cache.set(upload_hash, upload_phash, result)
+
+        omitted = budget.omitted()
+        for stage in omitted:
+            omitted_stages.inc(stage=stage)
+        if not include_images:
+            result = {key: value for key, value in result.items() if key not in ('species_images', 'variation_images')}
+        return dict(result, partial=bool(omitted), omitted=omitted, images_urls={
+            'species': species_images_url(result['species']),
+            'variation': {name: species_images_url(name, limit=1) for name in result['variation_species']}
+        })
+
+
+def run_identification(image_data, emit=None, include_images=True):
+    """
+    Runs the identification pipeline on raw image bytes.
+    Returns the response payload for /identify-bird.
+    `emit(event, data)`, when given, is called as each stage finishes.
+    """
+    emit = emit or (lambda event, data: None)
+    features = match = None
+    if first_tier is not None:
+        with timed('first_tier', provider='local') as timer:
+            features = first_tier.features(image_data)
+            match = first_tier.classify(features)
+            timer.status = 'hit' if match else 'miss'
+
+    if match:
+        # Close enough to past consensus answers, the providers are not asked
+        multi_response = {'local': {'species': match.species, 'confidence': round(match.confidence, 3)}}
+        emit('vote', {'provider': 'local', 'result': multi_response['local']})
+        species, votes, total = match.species, match.votes, len(match.neighbours)
+        consensus = True
+    else:
+        # Downscale and re-encode once, every model call reuses the same base64 payload
+        with timed('preprocess'):
+            prepared = prepare_image(image_data, max_edge=IMAGE_MAX_EDGE, quality=IMAGE_JPEG_QUALITY)
+        multi_response = multiple_responses(
+            prepared.encoded,
+            mime_type=prepared.mime_type,
+            on_result=lambda name, result: emit('vote', {'provider': name, 'result': result})
+        )
         species_list = []
-        for model, result in multi_response.items():
+        for model, result in (multi_response or {}).items():
             if result and 'species' in result:
                species_list.append(result['species'])
 
-        print('multi_response',multi_response)
-        # Create prompt for Gemini
-
-        prompt = """
-             
-             Identify the bird species in this image using the this other models responses below and classify with max voting.
-             responses :{species_list}
-             Provide the following information in your response:
-             1. The bird species name
-             2. A detailed markdown description of the bird attractive markdown only
-             3. A list of variation species or related species
-
-             Format your response as a JSON object with the following keys:
-             {
-                 "species": "bird species name",
-                 "description": "markdown description",
-                 "variation_species": ["species1", "species2", "species3", "species3", "species5"]
-             }
-             """
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
-
-        headers = {
-            "Content-Type": "application/json"
+        logger.debug(f"Provider answers: {multi_response}")
+
+        # Vote locally, the image only goes back to Gemini when the providers disagree
+        species, votes, total = get_index().tally(species_list)
+        consensus = species is not None and votes >= CONSENSUS_MIN_VOTES and votes * 2 > total
+        if consensus and first_tier is not None:
+            # Agreeing providers confirm the answer, the local tier learns it
+            first_tier.learn(features, species)
+
+    vote_summary = {'species': species, 'count': votes, 'total': total}
+    emitted = {}
+
+    def emit_species(name):
+        # Streamed clients get the species as soon as it is settled, before its description
+        emitted['species'] = name
+        emit('species', {'species': name, 'votes': vote_summary})
+
+    if consensus:
+        emit_species(species)
+        bird_data = dict(species_content_in_budget(species), species=species)
+    else:
+        bird_data = None
+        if species is None or budget.allows(AGGREGATION_MIN_BUDGET):
+            try:
+                bird_data = within_budget(
+                    aggregate_responses, prepared, species_list,
+                    on_field=lambda name, value: emit_species(value) if name == 'species' else None
+                )
+            except Exception as e:
+                if species is None:
+                    raise
+                if not isinstance(e, budget.BudgetExhausted):
+                    logger.warning(f"Aggregation failed, answering with the plurality species: {str(e)}")
+    aggregated = not consensus and bird_data is not None
+    if bird_data is None:
+        # No time to show Gemini the image again, or it failed: the plurality answer (or the one already streamed) stands
+        budget.omit('aggregation')
+        answer = emitted.get('species', species)
+        bird_data = dict(species_content_in_budget(answer), species=answer)
+    elif aggregated:
+        # The aggregated description is as good as a generated one, keep it for the next request
+        content_key = species_content_key(bird_data['species'])
+        if not content_cache.get(content_key)[0]:
+            content_cache.set(content_key, {
+                'description': bird_data['description'],
+                'variation_species': bird_data['variation_species']
+            })
+    if 'species' not in emitted:
+        emit_species(bird_data['species'])
+    emit('description', {'description': bird_data['description'], 'variation_species': bird_data['variation_species']})
+    
+    # Prepare final response
+    result = {
+        'responses': multi_response,
+        'species': bird_data['species'],
+        'votes': {
+            'species': species, 'count': votes, 'total': total, 'aggregated': aggregated,
+            'tier': 'local' if match else 'remote'
+        },
+        'description': bird_data['description'],
+        'variation_species': bird_data['variation_species'],
+    }
+    if not include_images:
+        return result
+
+    # Fetch images for identified species and variation species concurrently
+    result['species_images'], result['variation_images'] = resolve_species_images(
+        bird_data['species'], bird_data['variation_species'], limit=6,
+        on_result=lambda name, images, main: emit(
+            'species_images' if main else 'variation_images', {'species': name, 'images': images}
+        )
+    )
+    
+    return result
+
+
+DESCRIBE_PROMPT = """
+         Write about the bird species "{species}".
+         Provide the following information in your response:
+         1. A detailed markdown description of the bird attractive markdown only
+         2. A list of variation species or related species
+
+         Format your response as a JSON object with the following keys:
+         {{
+             "description": "markdown description",
+             "variation_species": ["species1", "species2", "species3", "species4", "species5"]
+         }}
+         """
+# Cached content is keyed by prompt version, so editing the prompt invalidates it
+CONTENT_PROMPT_VERSION = os.getenv('CONTENT_PROMPT_VERSION') or hashlib.sha1(DESCRIBE_PROMPT.encode()).hexdigest()[:8]
+
+
+def species_content_key(species):
+    return f"{CONTENT_PROMPT_VERSION}:{species_key(species)}"
+
+
+def species_content(species):
+    """
+    Description and variation species for a species, generated only on a cache miss.
+    """
+    return content_cache.get_or_compute(species_content_key(species), lambda: describe_species(species))
+
+
+def species_content_in_budget(species):
+    """
+    species_content within the request budget. Cached content is always served, but
+    generating it needs DESCRIPTION_MIN_BUDGET seconds. The description is optional:
+    without the time, or when generating it runs out of time or fails, it is omitted.
+    """
+    if budget.allows(DESCRIPTION_MIN_BUDGET):
+        try:
+            return within_budget(species_content, species)
+        except budget.BudgetExhausted:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not describe '{species}', answering without a description: {str(e)}")
+    else:
+        found, content = content_cache.get(species_content_key(species))
+        if found:
+            return content
+    budget.omit('description')
+    return {'description': '', 'variation_species': []}
+
+
+def within_budget(fn, *args, **kwargs):
+    """
+    Calls `fn`, waiting no longer than the request budget allows. Under a budget it
+    runs on its own thread and BudgetExhausted is raised if time runs out first.
+    The abandoned call keeps the same deadline, so its outbound requests are cut
+    off at that moment too rather than finishing in the background.
+    """
+    left = budget.remaining()
+    if left is None:
+        return fn(*args, **kwargs)
+    future = submit(budget_executor, fn, *args, **kwargs)
+    try:
+        return future.result(timeout=left)
+    except FutureTimeoutError:
+        raise budget.BudgetExhausted(f"{fn.__name__} did not finish within the request budget") from None
+
+
+def describe_species(species):
+    """
+    Text-only Gemini request for the description and related species of an agreed species.
+    """
+    bird_data = gemini_generate([{"text": DESCRIBE_PROMPT.format(species=species)}], stage='description',
+                               schema=DESCRIPTION_SCHEMA)
+    return {
+        'description': bird_data['description'],
+        'variation_species': bird_data['variation_species']
+    }
+
+
+@app.cli.command('prewarm-content')
+@click.argument('species_file', type=click.File())
+@click.option('--workers', default=4, show_default=True, help='Concurrent generation requests.')
+def prewarm_content(species_file, workers):
+    """Generates and caches descriptions for every species in SPECIES_FILE, one per line."""
+    species_names = [line.strip() for line in species_file if line.strip()]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor, priority(PREWARM):
+        futures = {submit(executor, species_content, name): name for name in species_names}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                click.echo(f"Failed to prewarm '{futures[future]}': {str(e)}", err=True)
+    click.echo(f"Prewarmed {len(species_names) - failed}/{len(species_names)} species")
+
+
+@app.cli.command('prewarm-images')
+@click.argument('species_file', type=click.File())
+@click.option('--output', '-o', default='species.manifest', show_default=True, help='Manifest file to write.')
+@click.option('--limit', default=6, show_default=True, help='Images stored per species.')
+@click.option('--workers', default=8, show_default=True, help='Species looked up concurrently.')
+@click.option('--per-minute', default=120, show_default=True, help='Species lookups started per minute, 0 for no limit.')
+def prewarm_images(species_file, output, limit, workers, per_minute):
+    """
+    Crawls image URLs and Wikipedia page ids for every species in SPECIES_FILE,
+    one per line, into a manifest. Point SPECIES_MANIFEST at it to serve those
+    species without outbound requests.
+    """
+    species_names = {}
+    for line in species_file:
+        if line.strip():
+            species_names.setdefault(species_key(line.strip()), line.strip())
+
+    limiter = RateLimiter('prewarm-images', per_minute=per_minute)
+    page_ids = _article_page_ids(list(species_names.values()))
+
+    def crawl(name):
+        limiter.acquire()
+        return _lookup_image_urls(name, limit)
+
+    records = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor, priority(PREWARM):
+        futures = {submit(executor, crawl, name): (key, name) for key, name in species_names.items()}
+        for future in as_completed(futures):
+            key, name = futures[future]
+            try:
+                images = future.result()
+            except Exception as e:
+                click.echo(f"Failed to look up '{name}': {str(e)}", err=True)
+                continue
+            records[key] = {'title': name, 'pageid': page_ids.get(name), 'limit': limit, 'images': images}
+
+    write_manifest(output, records)
+    found = sum(1 for record in records.values() if record['images'])
+    click.echo(f"Wrote {len(records)}/{len(species_names)} species to {output}, {found} with images")
+
+
+@app.cli.command('learn-images')
+@click.argument('folder', type=click.Path(exists=True, file_okay=False))
+def learn_images(folder):
+    """
+    Adds confirmed photos to the CLASSIFIER_INDEX local tier. FOLDER holds one
+    subfolder per species, named after it, with that species' photos inside.
+    """
+    if first_tier is None:
+        raise click.UsageError('Set CLASSIFIER_INDEX to the index file to build')
+    learned = 0
+    for species in sorted(os.listdir(folder)):
+        species_folder = os.path.join(folder, species)
+        if not os.path.isdir(species_folder):
+            continue
+        name = get_index().lookup(species) or species
+        for filename in sorted(os.listdir(species_folder)):
+            if not filename.lower().endswith(BATCH_IMAGE_EXTENSIONS):
+                continue
+            with open(os.path.join(species_folder, filename), 'rb') as f:
+                features = first_tier.features(f.read())
+            if features is None:
+                click.echo(f"Skipping unreadable '{species}/{filename}'", err=True)
+                continue
+            first_tier.learn(features, name)
+            learned += 1
+    click.echo(f"Learned {learned} photos, the index holds {len(first_tier.index)} entries")
+
+
+def _mediawiki_query(api_url, params):
+    """
+    Runs a MediaWiki API call and returns its JSON. Error statuses and error answers
+    raise, so a failed lookup is never taken for one that found nothing; only a
+    missing page counts as an answer.
+    """
+    response = http_client.get(api_url, params=params, timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    error = data.get("error")
+    if error and error.get("code") not in ("missingtitle", "invalidtitle"):
+        raise RuntimeError(f"MediaWiki API error {error.get('code')}: {error.get('info', '')}")
+    return data
+
+
+def _article_page_ids(titles):
+    """Maps article titles to Wikipedia page ids with batched, redirect-following queries."""
+    page_ids = {}
+    for start in range(0, len(titles), WIKI_TITLES_PER_QUERY):
+        batch = titles[start:start + WIKI_TITLES_PER_QUERY]
+        params = {
+            "action": "query",
+            "format": "json",
+            "titles": "|".join(batch),
+            "redirects": 1
         }
-        data = {
-            "contents": [
-                {
-                    "parts": [
-                        {"text": prompt},
-                        {
-                            "inline_data": {
-                                "mime_type": "image/jpeg",
-                                "data": encoded_image
-                            }
-                        }
-                    ]
-                }
-            ]
+        try:
+            query = _mediawiki_query(WIKIPEDIA_API_URL, params).get("query", {})
+        except Exception as e:
+            logger.warning(f"Page id lookup failed: {str(e)}")
+            continue
+
+        aliases = {title: title for title in batch}
+        for key in ("normalized", "redirects"):
+            for entry in query.get(key, []):
+                aliases[entry["to"]] = aliases.get(entry["from"], entry["from"])
+
+        for page in query.get("pages", {}).values():
+            if "pageid" in page:
+                page_ids[aliases.get(page["title"], page["title"])] = page["pageid"]
+    return page_ids
+
+
+def aggregate_responses(prepared, species_list, on_field=None):
+    """
+    Asks Gemini to settle a disagreement between providers, looking at the image again.
+    `on_field(name, value)` sees the species before the description has been generated.
+    """
+    prompt = f"""
+         
+         Identify the bird species in this image using the this other models responses below and classify with max voting.
+         responses :{json.dumps(species_list)}
+         Provide the following information in your response:
+         1. The bird species name
+         2. A detailed markdown description of the bird attractive markdown only
+         3. A list of variation species or related species
+
+         Format your response as a JSON object with the following keys:
+         {{
+             "species": "bird species name",
+             "description": "markdown description",
+             "variation_species": ["species1", "species2", "species3", "species4", "species5"]
+         }}
+         """
+    return gemini_generate([
+        {"text": prompt},
+        {
+            "inline_data": {
+                "mime_type": prepared.mime_type,
+                "data": http_client.JSONBlob(prepared.encoded)
+            }
         }
-        # Generate response from Gemini
-        response = requests.post(url, json=data, headers=headers)
-        if response.status_code != 200:
-            print(f"Error: {response.status_code}, {response.text}")
-            
-        
-        # Parse the response to extract JSON
-        response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-        # Extract JSON content from response if needed
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1
-        
-        if json_start >= 0 and json_end > json_start:
-            json_content = response_text[json_start:json_end]
-        else:
-            # Fallback if JSON format not detected
-            return jsonify({'error': 'Failed to parse Gemini response'}), 500
-        bird_data = json.loads(json_content)
-        
-        # Fetch images for identified species
-        species_images = []
-        species_images = get_image_urls(title=bird_data['species'], limit=6)
-        # if len(species_images) == 0:
-        #     species_images = fetch_species_images(bird_data['species'])
-        
-        # Fetch images for variation species
-        variation_images = {}
-        for variation in bird_data['variation_species']:
-            variation_images[variation] = get_image_urls(variation,1)
-        
-        # Prepare final response
-        result = {
-            'responses': multi_response,
-            'species': bird_data['species'],
-            'description': bird_data['description'],
-            'variation_species': bird_data['variation_species'],
-            'species_images': species_images,
-            'variation_images': variation_images
-        }   
-        
-        return jsonify(result)
-    
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    ], schema=AGGREGATION_SCHEMA, on_field=on_field)
+
+
+def gemini_generate(parts, stage='aggregation', schema=None, on_field=None):
+    """
+    Sends one Gemini request and returns the JSON object in its answer.
+    `stage` names the call in latency metrics and `schema` constrains the output.
+    `on_field(name, value)` is called as each field of the answer streams in.
+    """
+    rate_limiters['gemini'].acquire(timeout=budget.cap(PROVIDER_TIMEOUT))
+    with timed(stage, provider='gemini') as timer:
+        def check(response):
+            if response.status_code != 200:
+                timer.status = str(response.status_code)
+            check_response(response, 'gemini')
+
+        return llm.complete_json(
+            llm.GEMINI,
+            llm.gemini_url(GEMINI_API_BASE, GEMINI_MODEL, GEMINI_API_KEY, stream=STREAM_RESPONSES),
+            llm.gemini_payload(parts, schema, structured=STRUCTURED_OUTPUT),
+            stage, stream=STREAM_RESPONSES, on_field=on_field, check=check
+        )
 
 def fetch_species_images(species_name, max_images=6):
     """
     Search the web for images of the specified bird species
-    Returns a list of image URLs
+    Returns a list of image URLs, served from the image cache when possible
     """
     try:
-        search_term = f"{species_name} bird"
-        search_url = f"https://www.bing.com/images/search?q={search_term}"
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        response = requests.get(search_url, headers=headers)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Extract image URLs from the search results
-        # This pattern will need to be adjusted based on the actual structure of the search results
-        image_elements = soup.select('.iusc')
-        image_urls = []
-        
-        for element in image_elements[:max_images]:
-            if 'data-src' in element.attrs:
-                image_urls.append(element['data-src'])
-            elif 'm' in element.attrs:
-                # Parse JSON data if available
-                try:
-                    data = json.loads(element['m'])
-                    if 'murl' in data:
-                        image_urls.append(data['murl'])
-                except:
-                    pass
-                    
-        # Return at least a few images or empty list if none found
-        return image_urls
-    
+        return _cached_bing_images(species_name, max_images)
     except Exception as e:
-        print(f"Error fetching images for {species_name}: {str(e)}")
+        if not budget.allows(budget.MIN_CALL_SECONDS):
+            # Cut short by the request budget, which says nothing about the species, so nothing is cached
+            raise budget.BudgetExhausted(str(e)) from e
+        logger.warning(f"Error fetching images for {species_name}: {str(e)}")
         return []
 
+def _cached_bing_images(species_name, max_images=6):
+    """Bing image search through the image cache. Errors propagate, so a failed search is never cached."""
+    return image_cache.get_or_compute(
+        f"bing:{species_key(species_name)}:{max_images}",
+        lambda: _search_bing_images(species_name, max_images)
+    )
+
+def _search_bing_images(species_name, max_images=6):
+    """
+    Scrapes Bing image search for the specified bird species.
+    Errors propagate so that failed searches are never cached.
+    """
+    search_term = f"{species_name} bird"
+    search_url = f"{BING_BASE_URL}/images/search?q={search_term}"
+    
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    }
+    
+    # Streamed and scanned incrementally; the download stops once enough results are read
+    with timed('bing_search', provider='bing'):
+        with http_client.get(search_url, headers=headers, stream=True) as response:
+            # An error page has no results either, it must not pass for a search that found nothing
+            response.raise_for_status()
+            return extract_image_urls(response.iter_content(chunk_size=BING_CHUNK_SIZE), max_images)
+
 def fetch_single_image(species_name):
     """
     Search the web for a single image of the specified bird species
@@ -186,260 +1119,380 @@ def fetch_single_image(species_name):
     return images[0] if images else ""
 
 def get_image_urls(title, limit=5):
+    """
+    Get multiple image URLs for a Wikipedia article by title.
+    Results, including empty ones, are cached per species and limit; failed lookups
+    raise and are not cached. Species in the prewarmed manifest are answered without any request.
+    """
+    if species_manifest is not None:
+        record = species_manifest.get(species_key(title))
+        if record is not None and (record['limit'] >= limit or len(record['images']) >= limit):
+            return record['images'][:limit]
+
+    return image_cache.get_or_compute(
+        f"wiki:{species_key(title)}:{limit}",
+        lambda: _lookup_image_urls(title, limit)
+    )
+
+
+def _lookup_image_urls(title, limit=5):
     """
     Get multiple image URLs for a Wikipedia article by title using multiple methods.
     Falls back to more generic searches for birds when direct page images aren't available.
+    Every method resolves its file URLs in batched requests rather than one per file.
+    Raises when the lookup failed rather than found nothing, so get_image_urls only
+    caches real empty answers.
     """
-    # Base URL for the Wikipedia API
-    api_url = "https://en.wikipedia.org/w/api.php"
-    
     image_urls = []
     
     try:
-        # Method 1: Try using parse API first
-        # logger.info(f"Attempting to get images for '{title}' using parse API")
-        
-        # First, we need to get the pageId for the article
-        params = {
-            "action": "query",
-            "format": "json",
-            "titles": title,
-        }
-        
-        response = requests.get(api_url, params=params, timeout=10)
-        data = response.json()
+        # Method 1: Images used on the article itself, in page order
+        image_urls = _timed_tier('wiki_article', 'wikipedia', _article_image_urls, title, limit)
         
-        # Extract page ID
-        pages = data.get("query", {}).get("pages", {})
-        if not pages:
-            logger.warning("No pages found in API response")
-        else:
-            page_id = list(pages.keys())[0]
-            
-            if page_id != "-1":
-                # Get images with parse API
-                params = {
-                    "action": "parse",
-                    "format": "json",
-                    "pageid": page_id,
-                    "prop": "images"
-                }
-                
-                response = requests.get(api_url, params=params, timeout=10)
-                data = response.json()
-                
-                if "parse" in data and "images" in data["parse"] and data["parse"]["images"]:
-                    # Get image file names
-                    images = data["parse"]["images"]
-                    logger.info(f"Found {len(images)} images with parse API")
-                    
-                    # Filter out non-content images (commons icons, etc.)
-                    filtered_images = [img for img in images if not img.lower().startswith(('icon-', 'commons-', 'edit-'))]
-                    
-                    # Apply limit
-                    filtered_images = filtered_images[:limit]
-                    
-                    # Get URLs for images
-                    for img_name in filtered_images:
-                        img_params = {
-                            "action": "query",
-                            "format": "json",
-                            "titles": f"File:{img_name}",
-                            "prop": "imageinfo",
-                            "iiprop": "url"
-                        }
-                        
-                        img_response = requests.get(api_url, params=img_params, timeout=10)
-                        img_data = img_response.json()
-                        
-                        img_pages = img_data.get("query", {}).get("pages", {})
-                        if img_pages:
-                            img_page_id = list(img_pages.keys())[0]
-                            
-                            if "imageinfo" in img_pages[img_page_id]:
-                                image_url = img_pages[img_page_id]["imageinfo"][0]["url"]
-                                image_urls.append(image_url)
-                else:
-                    logger.warning(f"No images found with parse API for '{title}'")
-        
-        # Method 2: If no images found, try with fileusage query
+        # Method 2: If no images found, search file titles matching the article title
         if not image_urls:
-            logger.info(f"Trying fileusage query for '{title}'")
-            
-            # Search for files that are used on pages with this title
+            logger.info(f"Trying file title search for '{title}'")
             search_title = title.replace(" ", "_")
-            params = {
-                "action": "query",
-                "format": "json",
-                "list": "search",
-                "srsearch": f"File:{search_title}",
-                "srnamespace": "6",  # File namespace
-                "srlimit": limit
-            }
-            
-            response = requests.get(api_url, params=params, timeout=10)
-            data = response.json()
-            
-            if "query" in data and "search" in data["query"]:
-                search_results = data["query"]["search"]
-                logger.info(f"Found {len(search_results)} files with title search")
-                
-                for result in search_results[:limit]:
-                    file_title = result["title"]
-                    
-                    img_params = {
-                        "action": "query",
-                        "format": "json",
-                        "titles": file_title,
-                        "prop": "imageinfo",
-                        "iiprop": "url"
-                    }
-                    
-                    img_response = requests.get(api_url, params=img_params, timeout=10)
-                    img_data = img_response.json()
-                    
-                    img_pages = img_data.get("query", {}).get("pages", {})
-                    if img_pages:
-                        img_page_id = list(img_pages.keys())[0]
-                        
-                        if "imageinfo" in img_pages[img_page_id]:
-                            image_url = img_pages[img_page_id]["imageinfo"][0]["url"]
-                            image_urls.append(image_url)
+            image_urls = _timed_tier('wiki_file_search', 'wikipedia', _search_image_urls,
+                                     WIKIPEDIA_API_URL, f"File:{search_title}", limit)
         
         # Method 3: If still no images, try searching more generically
         if not image_urls:
-            logger.info(f"Trying commons category search for '{title}'")
-            
-            # Try searching commons for this bird species
-            commons_search = f"{title} bird"
-            params = {
-                "action": "query",
-                "format": "json",
-                "list": "search",
-                "srsearch": commons_search,
-                "srnamespace": "6",  # File namespace
-                "srlimit": limit
-            }
-            
-            response = requests.get(api_url, params=params, timeout=10)
-            data = response.json()
-            
-            if "query" in data and "search" in data["query"]:
-                search_results = data["query"]["search"]
-                logger.info(f"Found {len(search_results)} files with generic search")
-                
-                for result in search_results[:limit]:
-                    file_title = result["title"]
-                    
-                    img_params = {
-                        "action": "query",
-                        "format": "json",
-                        "titles": file_title,
-                        "prop": "imageinfo",
-                        "iiprop": "url"
-                    }
-                    
-                    img_response = requests.get(api_url, params=img_params, timeout=10)
-                    img_data = img_response.json()
-                    
-                    img_pages = img_data.get("query", {}).get("pages", {})
-                    if img_pages:
-                        img_page_id = list(img_pages.keys())[0]
-                        
-                        if "imageinfo" in img_pages[img_page_id]:
-                            image_url = img_pages[img_page_id]["imageinfo"][0]["url"]
-                            image_urls.append(image_url)
+            logger.info(f"Trying generic file search for '{title}'")
+            image_urls = _timed_tier('wiki_generic_search', 'wikipedia', _search_image_urls,
+                                     WIKIPEDIA_API_URL, f"{title} bird", limit)
         
-        # Method 4: If all else fails, try with the generic "bird" category
+        # Method 4: If all else fails, search Wikimedia Commons directly
         if not image_urls:
             logger.info(f"Falling back to Wikimedia Commons search for '{title}'")
-            
-            # Search directly in commons
-            commons_api_url = "https://commons.wikimedia.org/w/api.php"
-            params = {
-                "action": "query",
-                "format": "json",
-                "list": "search",
-                "srsearch": f"\"{title}\" bird",
-                "srnamespace": "6",  # File namespace
-                "srlimit": limit
-            }
-            
-            response = requests.get(commons_api_url, params=params, timeout=10)
-            data = response.json()
-            
-            if "query" in data and "search" in data["query"]:
-                search_results = data["query"]["search"]
-                logger.info(f"Found {len(search_results)} files in Commons")
-                
-                for result in search_results[:limit]:
-                    file_title = result["title"]
-                    
-                    img_params = {
-                        "action": "query",
-                        "format": "json",
-                        "titles": file_title,
-                        "prop": "imageinfo",
-                        "iiprop": "url"
-                    }
-                    
-                    img_response = requests.get(commons_api_url, params=img_params, timeout=10)
-                    img_data = img_response.json()
-                    
-                    img_pages = img_data.get("query", {}).get("pages", {})
-                    if img_pages:
-                        img_page_id = list(img_pages.keys())[0]
-                        
-                        if "imageinfo" in img_pages[img_page_id]:
-                            image_url = img_pages[img_page_id]["imageinfo"][0]["url"]
-                            image_urls.append(image_url)
-        
-        # Final fallback - if we still don't have images and you have your fetch_species_images function
-        if not image_urls and 'fetch_species_images' in globals():
-            logger.info(f"Final fallback to web search for '{title}'")
-            return fetch_species_images(f"{title} bird", max_images=limit)
-        
-        logger.info(f"Successfully retrieved {len(image_urls)} image URLs")
-        return image_urls
-        
+            image_urls = _timed_tier('commons_search', 'commons', _search_image_urls,
+                                     COMMONS_API_URL, f"\"{title}\" bird", limit)
     except Exception as e:
+        if not budget.allows(budget.MIN_CALL_SECONDS):
+            raise budget.BudgetExhausted(str(e)) from e
         logger.error(f"Error in get_image_urls: {str(e)}")
-        # If we encounter an error but have your fetch_species_images function, use it as fallback
-        if 'fetch_species_images' in globals():
-            logger.info(f"Error encountered, falling back to web search for '{title}'")
-            return fetch_species_images(f"{title} bird", max_images=limit)
-        raise Exception(f"Error processing Wikipedia data: {str(e)}")
+        error = e
+    else:
+        if image_urls:
+            logger.info(f"Successfully retrieved {len(image_urls)} image URLs")
+            return image_urls
+        error = None
+
+    # Final fallback, a web search, whose errors propagate
+    logger.info(f"Falling back to web search for '{title}'")
+    image_urls = _cached_bing_images(f"{title} bird", max_images=limit)
+    if not image_urls and error is not None:
+        # Nothing found after a failed lookup is not a real miss, keep it out of the cache
+        raise Exception(f"Error processing Wikipedia data: {str(error)}") from error
+    return image_urls
+
+
+def _timed_tier(stage, provider, lookup, *args):
+    """Runs one image lookup method, recording its latency and whether it found anything."""
+    with timed(stage, provider=provider) as timer:
+        image_urls = lookup(*args)
+        if not image_urls:
+            timer.status = 'empty'
+    return image_urls
 
+
+def _article_image_urls(title, limit):
+    """
+    Returns URLs of the content images on a Wikipedia article.
+    Takes two round trips: one parse call for the file names and one
+    batched imageinfo call for their URLs.
+    """
+    params = {
+        "action": "parse",
+        "format": "json",
+        "page": title,
+        "redirects": 1,
+        "prop": "images"
+    }
+    data = _mediawiki_query(WIKIPEDIA_API_URL, params)
+    
+    images = data.get("parse", {}).get("images")
+    if not images:
+        logger.warning(f"No images found with parse API for '{title}'")
+        return []
+    logger.info(f"Found {len(images)} images with parse API")
+    
+    # Filter out non-content images (commons icons, etc.)
+    filtered_images = [img for img in images if not img.lower().startswith(('icon-', 'commons-', 'edit-'))]
+    
+    return _resolve_file_urls(WIKIPEDIA_API_URL, [f"File:{img}" for img in filtered_images[:limit]])
+
+
+def _resolve_file_urls(api_url, file_titles):
+    """
+    Resolves file titles to image URLs with multi-title imageinfo queries.
+    URLs are returned in the order of `file_titles`; files without imageinfo are skipped.
+    """
+    urls_by_title = {}
+    
+    for start in range(0, len(file_titles), WIKI_TITLES_PER_QUERY):
+        batch = file_titles[start:start + WIKI_TITLES_PER_QUERY]
+        params = {
+            "action": "query",
+            "format": "json",
+            "titles": "|".join(batch),
+            "prop": "imageinfo",
+            "iiprop": "url"
+        }
+        query = _mediawiki_query(api_url, params).get("query", {})
         
-def multiple_responses(image_data):
-    responses = {}
+        # The API answers with normalized titles, so map them back to what we asked for
+        aliases = {title: title for title in batch}
+        for key in ("normalized", "redirects"):
+            for entry in query.get(key, []):
+                aliases[entry["to"]] = aliases.get(entry["from"], entry["from"])
+        
+        for page in query.get("pages", {}).values():
+            if "imageinfo" in page:
+                requested = aliases.get(page.get("title"), page.get("title"))
+                urls_by_title[requested] = page["imageinfo"][0]["url"]
+    
+    return [urls_by_title[title] for title in file_titles if title in urls_by_title]
 
 
+def _search_image_urls(api_url, search, limit):
+    """
+    Full-text searches the File namespace and returns image URLs in rank order.
+    The search and the imageinfo lookup happen in a single generator query.
+    """
+    params = {
+        "action": "query",
+        "format": "json",
+        "generator": "search",
+        "gsrsearch": search,
+        "gsrnamespace": "6",  # File namespace
+        "gsrlimit": limit,
+        "prop": "imageinfo",
+        "iiprop": "url"
+    }
+    data = _mediawiki_query(api_url, params)
+    
+    pages = list(data.get("query", {}).get("pages", {}).values())
+    logger.info(f"Found {len(pages)} files searching '{search}'")
+    pages.sort(key=lambda page: page.get("index", 0))
+    
+    return [page["imageinfo"][0]["url"] for page in pages[:limit] if "imageinfo" in page]
+
+
+def resolve_species_images(species, variation_species, limit=6, variation_limit=1, on_result=None):
+    """
+    Fetches images for the identified species and every variation species concurrently.
+    Returns (species_images, variation_images).
+    `on_result(name, images, is_main_species)` is called as each lookup completes.
+    Under a request budget the lookups are skipped with less than IMAGES_MIN_BUDGET
+    seconds left, and cut off when it runs out; what is missing is marked omitted.
+    """
+    if not budget.allows(IMAGES_MIN_BUDGET):
+        budget.omit('species_images')
+        budget.omit('variation_images')
+        return [], {}
+
+    species_future = submit(lookup_executor, get_image_urls, species, limit)
+    variation_futures = {
+        variation: submit(lookup_executor, get_image_urls, variation, variation_limit)
+        for variation in variation_species
+    }
+    names = {species_future: species}
+    names.update({future: variation for variation, future in variation_futures.items()})
+
+    results = {}
     try:
-        responses['gemini'] = gemini_res(image_data)
-    except Exception as e:
-        print(f"Error in gemini_res: {str(e)}")
+        for future in as_completed(names, timeout=budget.remaining()):
+            try:
+                results[future] = future.result()
+            except budget.BudgetExhausted:
+                continue
+            except Exception as e:
+                # Left out like a cut-off lookup, so the partial result isn't cached either
+                logger.warning(f"Image lookup for '{names[future]}' failed: {str(e)}")
+                continue
+            if on_result:
+                on_result(names[future], results[future], future is species_future)
+    except FutureTimeoutError:
+        pass  # the lookups still running share the deadline and are cut off with it
+
+    if species_future not in results:
+        budget.omit('species_images')
+    if len(results) - (species_future in results) < len(variation_futures):
+        budget.omit('variation_images')
+    species_images = results.get(species_future, [])
+    variation_images = {
+        variation: results[future] for variation, future in variation_futures.items() if future in results
+    }
+    return species_images, variation_images
+
+        
+def multiple_responses(image_data, mime_type="image/jpeg", quorum=None, provider_timeout=None, deadline=None,
+                       on_result=None):
+    """
+    Query every vision provider concurrently.
+    Returns as soon as `quorum` providers agree on a species, or once the
+    overall deadline passes; providers still running at that point are ignored.
+    Providers with an open circuit are skipped, and a provider slower than its
+    recent p95 gets one hedged duplicate call; whichever answers first counts.
+    `on_result(name, result)` is called as each provider answers.
+    """
+    quorum = FANOUT_QUORUM if quorum is None else quorum
+    provider_timeout = PROVIDER_TIMEOUT if provider_timeout is None else provider_timeout
+    deadline = FANOUT_DEADLINE if deadline is None else deadline
+    # The request budget, when there is one, bounds the whole fan-out
+    provider_timeout = budget.cap(provider_timeout)
+    deadline = budget.cap(deadline)
+
+    providers = {
+        'gemini': gemini_res,
+        'mistral': mistral_res,
+        'llama': llama_res,
+    }
+    available = {name: provider for name, provider in providers.items() if provider_health[name].allow_request()}
+    for name in providers.keys() - available.keys():
+        logger.warning(f"Skipping '{name}', its circuit is open")
+        skipped_calls.inc(provider=name)
+    if not available:
+        # Every circuit is open, trying them all beats answering nothing
+        available = providers
+    if quorum:
+        # Fewer voters after routing around open circuits, don't wait for a quorum they can't reach
+        quorum = min(quorum, len(available))
 
+    def launch(name):
+        return submit(provider_executor, call_provider, name, available[name], image_data,
+                      mime_type=mime_type, timeout=provider_timeout)
+
+    futures = {launch(name): name for name in available}
+    started_at = time.monotonic()
+    hedge_at = {}
+    if HEDGE_REQUESTS:
+        for name in available:
+            p95 = provider_health[name].percentile(95)
+            if p95 is not None and provider_health[name].state == CLOSED:
+                hedge_at[name] = started_at + max(p95, HEDGE_MIN_DELAY)
+
+    responses = {}
+    votes = {}
+    finished = set()  # providers that answered or failed for good
+    pending = set(futures)
+    # No provider gets longer than its own timeout, whatever the overall deadline
+    expires_at = started_at + min(deadline, provider_timeout)
+
+    while pending:
+        now = time.monotonic()
+        remaining = expires_at - now
+        if remaining <= 0:
+            break
+        if hedge_at:
+            remaining = max(0, min(remaining, min(hedge_at.values()) - now))
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+
+        now = time.monotonic()
+        for name, hedge_time in list(hedge_at.items()):
+            if hedge_time <= now:
+                del hedge_at[name]
+                logger.info(f"'{name}' is slower than its recent p95, sending a hedged request")
+                hedged_calls.inc(provider=name)
+                future = launch(name)
+                futures[future] = name
+                pending.add(future)
+
+        reached_quorum = False
+        # Answers first: a failed call finished in the same batch as its successful
+        # sibling must not mark the provider finished before the answer is seen
+        for future in sorted(done, key=lambda future: future.exception() is not None):
+            name = futures[future]
+            if name in finished:
+                continue
+            siblings = {other for other in pending if futures[other] == name}
+            try:
+                result = future.result()
+            except Exception as e:
+                if siblings:
+                    # The other call for this provider may still answer
+                    continue
+                logger.warning(f"Error in {name}_res: {str(e)}")
+                finished.add(name)
+                hedge_at.pop(name, None)
+                continue
+
+            finished.add(name)
+            hedge_at.pop(name, None)
+            for sibling in siblings:
+                if sibling.cancel():
+                    provider_health[name].release()
+            pending -= siblings
+
+            responses[name] = result
+            if on_result:
+                on_result(name, result)
+            if result and 'species' in result:
+                key = species_key(result['species'])
+                votes[key] = votes.get(key, 0) + 1
+                if quorum and votes[key] >= quorum:
+                    reached_quorum = True
+
+        if reached_quorum:
+            break
+
+    for future in pending:
+        # Stragglers that already started keep running in the pool, their result is dropped.
+        # A call cancelled before it started gives back its half-open trial slot.
+        if future.cancel():
+            provider_health[futures[future]].release()
+    for name in {futures[future] for future in pending} - finished:
+        logger.info(f"Ignoring slow provider '{name}'")
+
+    return responses if responses else None
+
+
+def call_provider(name, provider, *args, **kwargs):
+    """
+    Calls one vision provider once its quota allows, recording its latency
+    under the provider's name and its outcome in the provider's health tracker.
+    """
     try:
-        responses['mistral'] = mistral_res(image_data)
-    except Exception as e:
-        print(f"Error in mistral_res: {str(e)}")
+        rate_limiters[PROVIDER_QUOTAS[name]].acquire(timeout=kwargs.get('timeout'))
+    except RateLimitExceeded:
+        # Never reached the provider, so this says nothing about its health
+        provider_health[name].release()
+        raise
 
+    started = time.monotonic()
     try:
-        responses['llama'] = llama_res(image_data)
+        with timed('provider', provider=name) as timer:
+            result = provider(*args, **kwargs)
+            if not result:
+                timer.status = 'empty'
     except Exception as e:
-        print(f"Error in llama_res: {str(e)}")
-
-    return responses if responses else None
+        if isinstance(e, budget.BudgetExhausted) or not budget.allows(budget.MIN_CALL_SECONDS):
+            # Cut off by the request's own deadline, which says nothing about the provider either
+            provider_health[name].release()
+        else:
+            provider_health[name].record(time.monotonic() - started, False)
+        raise
+    provider_health[name].record(time.monotonic() - started, True)
+    return result
 
 
-def gemini_res(image_data):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+def check_response(response, quota):
+    """
+    Raises for a non-200 provider answer instead of failing later while parsing it.
+    A 429 also pauses the quota so queued calls don't repeat the rejection.
+    """
+    if response.status_code == 429:
+        try:
+            retry_after = float(response.headers.get('Retry-After', RATE_LIMIT_PENALTY))
+        except ValueError:
+            retry_after = RATE_LIMIT_PENALTY
+        rate_limiters[quota].penalize(retry_after)
+    if response.status_code != 200:
+        raise RuntimeError(f"{quota} returned {response.status_code}: {response.text[:200]}")
 
-    headers = {
-        "Content-Type": "application/json"
-    }
 
+def gemini_res(image_data, mime_type="image/jpeg", timeout=None):
     prompt = """ Classify what kind of bird in JSON output
 
     Use this JSON schema:
@@ -447,48 +1500,34 @@ def gemini_res(image_data):
     {'species': str,'reason':give reason for why you have classified this bird species } only json no headings
     """
 
-    data = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": prompt},
-                    {
-                        "inline_data": {
-                            "mime_type": "image/jpeg",
-                            "data": image_data
-                        }
-                    }
-                ]
+    parts = [
+        {"text": prompt},
+        {
+            "inline_data": {
+                "mime_type": mime_type,
+                "data": http_client.JSONBlob(image_data)
             }
-        ]
-    }
-
+        }
+    ]
     try:
-        response = requests.post(url, json=data, headers=headers)
+        bird_data = llm.complete_json(
+            llm.GEMINI,
+            llm.gemini_url(GEMINI_API_BASE, GEMINI_MODEL, GEMINI_API_KEY, stream=STREAM_RESPONSES),
+            llm.gemini_payload(parts, CLASSIFICATION_SCHEMA, structured=STRUCTURED_OUTPUT),
+            'gemini', timeout=timeout, stream=STREAM_RESPONSES,
+            check=functools.partial(check_response, quota='gemini')
+        )
     except Exception as e:
-        print(f"Error in gemini_res: {str(e)}")
-
-
-    response_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-    # Extract JSON content from response if needed
-    json_start = response_text.find('{')
-    json_end = response_text.rfind('}') + 1
-    if json_start >= 0 and json_end > json_start:
-        json_content = response_text[json_start:json_end]
-    else:
-        # Fallback if JSON format not detected
-        return 
-    json_content = json_content.replace("'", '"')  
-    bird_data = json.loads(json_content)
-    print("gemini:",bird_data)
+        logger.warning(f"Error in gemini_res: {str(e)}")
+        raise
+    logger.debug(f"gemini: {bird_data}")
     return bird_data
 
-def mistral_res(image_data):
+def mistral_res(image_data, mime_type="image/jpeg", timeout=None):
     MISTRAL_API_KEY = os.getenv('MISTRAL_API_KEY')
 
-    url = "https://api.mistral.ai/v1/chat/completions"
+    url = f"{MISTRAL_API_BASE}/v1/chat/completions"
     headers = {
-        "Content-Type": "application/json",
         "Authorization": f"Bearer {MISTRAL_API_KEY}"
     }
 
@@ -498,54 +1537,35 @@ def mistral_res(image_data):
     {'species': str, 'reason':give reason for why you have classified this bird species}
     """
 
-    data = {
-        "model": "pixtral-12b-2409",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                    "type": "image_url",
-                    "image_url": f"data:image/jpeg;base64,{image_data}"
-                }
-                ]
-            }
-        ],
-        "max_tokens": 300
-    }
+    content = [
+        {"type": "text", "text": prompt},
+        {
+            "type": "image_url",
+            "image_url": http_client.JSONBlob(f"data:{mime_type};base64,", image_data)
+        }
+    ]
     try:
-        response = requests.post(url, json=data, headers=headers)
+        # Mistral's JSON mode takes no schema, the prompt describes it
+        bird_data = llm.complete_json(
+            llm.CHAT, url,
+            llm.chat_payload("pixtral-12b-2409", content, structured=STRUCTURED_OUTPUT, stream=STREAM_RESPONSES,
+                             max_tokens=300),
+            'mistral', headers=headers, timeout=timeout, stream=STREAM_RESPONSES,
+            check=functools.partial(check_response, quota='mistral')
+        )
     except Exception as e:
-        print(f"Error in mistral_res: {str(e)}")
-
-    # if response.status_code == 200:
-    #     print(response.json()['choices'][0]['message']['content'])
-    # else:
-        # print(f"Error: {response.status_code}, {response.text}")
-
-    response_text = response.json()['choices'][0]['message']['content']
-    # Extract JSON content from response if needed
-    json_start = response_text.find('{')
-    json_end = response_text.rfind('}') + 1
-    if json_start >= 0 and json_end > json_start:
-        json_content = response_text[json_start:json_end]
-    else:
-        # Fallback if JSON format not detected
-        return 
-    json_content = json_content.replace("'", '"')  
-    bird_data = json.loads(json_content)
-    print("mistral:",bird_data)
+        logger.warning(f"Error in mistral_res: {str(e)}")
+        raise
+    logger.debug(f"mistral: {bird_data}")
     return bird_data
 
-def llama_res(image_data):
+def llama_res(image_data, mime_type="image/jpeg", timeout=None):
     TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")  # Ensure your API key is set in environment variables
 
-    url = "https://api.together.xyz/v1/chat/completions"
+    url = f"{TOGETHER_API_BASE}/v1/chat/completions"
 
     headers = {
-        "Authorization": f"Bearer {TOGETHER_API_KEY}",
-        "Content-Type": "application/json"
+        "Authorization": f"Bearer {TOGETHER_API_KEY}"
     }
 
     prompt = """ Classify what kind of bird in ***JSON*** ONLY
@@ -555,48 +1575,29 @@ def llama_res(image_data):
     {'species': str,'reason':give reason for why you have classified this bird species}
     """
 
-    data = {
-        "model": "meta-llama/Llama-Vision-Free",
-        "messages": [
-            {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_data}",
-                        },
-                    },
-                ],}
-        ]
-    }
-
+    content = [
+        {"type": "text", "text": prompt},
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": http_client.JSONBlob(f"data:{mime_type};base64,", image_data),
+            },
+        },
+    ]
     try:
-        response = requests.post(url, json=data, headers=headers)
+        bird_data = llm.complete_json(
+            llm.CHAT, url,
+            llm.chat_payload("meta-llama/Llama-Vision-Free", content, CLASSIFICATION_SCHEMA,
+                             structured=STRUCTURED_OUTPUT, stream=STREAM_RESPONSES),
+            'llama', headers=headers, timeout=timeout, stream=STREAM_RESPONSES,
+            check=functools.partial(check_response, quota='together')
+        )
     except Exception as e:
-        print(f"Error in llama_res: {str(e)}")
-
-    # if response.status_code == 200:
-    #     print(response.json()["choices"][0]["message"]["content"])
-    # else:
-    #     print(f"Error: {response.status_code}, {response.text}")
-
-    response_text = response.json()["choices"][0]["message"]["content"]
-    print(response_text)
-    # Extract JSON content from response if needed
-    json_start = response_text.find('{')
-    json_end = response_text.rfind('}') + 1
-    if json_start >= 0 and json_end > json_start:
-        json_content = response_text[json_start:json_end]
-    else:
-        # Fallback if JSON format not detected
-        return 
-    json_content = json_content.replace("'", '"')  
-    
-    bird_data = json.loads(json_content)
-    print("llama:",bird_data)
+        logger.warning(f"Error in llama_res: {str(e)}")
+        raise
+    logger.debug(f"llama: {bird_data}")
     return bird_data
 
 
-
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
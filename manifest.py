@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'BIRDMAN1'
+_HEADER = struct.Struct('<8sI4x')  # magic, entry count
+_ENTRY = struct.Struct('<QII')  # key hash, record offset, record length
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+
+def write_manifest(path, records):
+    """
+    Writes `records`, a mapping of species key to JSON-serializable record, as a manifest.
+    The file is a sorted table of (key hash, offset, length) entries followed by the
+    JSON records, so readers can binary search it straight from a memory map.
+    Replaces `path` atomically.
+    """
+    entries = []
+    blob = bytearray()
+    for key, record in records.items():
+        data = json.dumps(dict(record, key=key), separators=(',', ':')).encode()
+        entries.append((_key_hash(key), len(blob), len(data)))
+        blob += data
+    entries.sort()
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, len(entries)))
+        for entry in entries:
+            f.write(_ENTRY.pack(*entry))
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+class SpeciesManifest:
+    """
+    Read-only species manifest written by `write_manifest`.
+    The file is memory mapped on first use, so opening it costs nothing and every
+    gunicorn worker shares the same page cache. A missing or unreadable file
+    behaves as an empty manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._count = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+
+    def _open(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            try:
+                with open(self.path, 'rb') as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, self._count = _HEADER.unpack_from(self._map, 0)
+                if magic != MAGIC:
+                    raise ValueError('not a species manifest')
+                logger.info(f"Loaded species manifest '{self.path}' with {self._count} entries")
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"Ignoring species manifest '{self.path}': {str(e)}")
+                self._map, self._count = None, 0
+
+    def _record(self, index):
+        key_hash, offset, length = _ENTRY.unpack_from(self._map, _HEADER.size + index * _ENTRY.size)
+        start = _HEADER.size + self._count * _ENTRY.size + offset
+        return key_hash, start, length
+
+    def get(self, key):
+        """The record stored for `key`, or None."""
+        if not self._loaded:
+            self._open()
+        target = _key_hash(key)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        # Entries sharing a hash sit next to each other, the stored key tells them apart
+        while low < self._count:
+            key_hash, start, length = self._record(low)
+            if key_hash != target:
+                break
+            record = json.loads(self._map[start:start + length])
+            if record.get('key') == key:
+                self._count_event('hits')
+                return record
+            low += 1
+        self._count_event('misses')
+        return None
+
+    def _count_event(self, event):
+        with self._lock:
+            self._counters[event] += 1
+
+    def __len__(self):
+        if not self._loaded:
+            self._open()
+        return self._count
+
+    def stats(self):
+        return dict(self._counters, entries=len(self))
@@ -0,0 +1,189 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers cached lookups through slow free-tier model calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+_registry = []
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter with labels, rendered in Prometheus text format."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labelnames, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        samples = []
+        bucket_labelnames = self.labelnames + ('le',)
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series):
+                    samples.append((f'{self.name}_bucket', bucket_labelnames, key + (repr(float(bound)),), count))
+                samples.append((f'{self.name}_bucket', bucket_labelnames, key + ('+Inf',), series[-1]))
+                samples.append((f'{self.name}_sum', self.labelnames, key, series[-2]))
+                samples.append((f'{self.name}_count', self.labelnames, key, series[-1]))
+        return samples
+
+
+class CallbackMetric:
+    """
+    Metric whose samples are read from `callback()` at scrape time,
+    for state that already lives elsewhere such as cache statistics.
+    `callback` returns a mapping of label value tuples to numbers.
+    """
+
+    def __init__(self, name, documentation, labelnames, callback, type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.type = type
+        _registry.append(self)
+
+    def samples(self):
+        return [(self.name, self.labelnames, tuple(key), value) for key, value in self.callback().items()]
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for sample_name, labelnames, values, value in metric.samples():
+            lines.append(f'{sample_name}{_format_labels(labelnames, values)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram(
+    'bird_stage_duration_seconds',
+    'Time spent in each identification stage.',
+    ['stage', 'provider', 'status']
+)
+
+
+class StageTimer:
+    """Handle yielded by `timed`; set `status` to record an outcome other than ok/error."""
+
+    def __init__(self):
+        self.status = 'ok'
+
+
+@contextmanager
+def timed(stage, provider=''):
+    """
+    Records how long the block takes in `bird_stage_duration_seconds` and, when
+    a request is being timed, in that request's Server-Timing summary.
+    """
+    timer = StageTimer()
+    start = time.perf_counter()
+    try:
+        yield timer
+    except BaseException:
+        timer.status = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage, provider=provider, status=timer.status)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((f'{stage}-{provider}' if provider else stage, elapsed))
+
+
+def start_request_timing():
+    """Begins collecting stage timings for the current request context."""
+    _request_timings.set([])
+
+
+def server_timing_header(total=None):
+    """
+    Summarizes the current request's stage timings as a Server-Timing header value.
+    Stages that ran more than once are summed.
+    """
+    timings = _request_timings.get()
+    if not timings and total is None:
+        return None
+    durations = {}
+    for name, elapsed in timings or []:
+        durations[name] = durations.get(name, 0) + elapsed
+    if total is not None:
+        durations['total'] = total
+    return ', '.join(f'{name};dur={elapsed * 1000:.1f}' for name, elapsed in durations.items())
+
+
+def submit(executor, fn, *args, **kwargs):
+    """
+    executor.submit that runs `fn` in a copy of the caller's context,
+    so stage timings from worker threads land on the right request and
+    the request's priority and time budget apply there too.
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
@@ -0,0 +1,169 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Lower value is served first
+INTERACTIVE = 0
+BATCH = 1
+PREWARM = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BATCH: 'batch', PREWARM: 'prewarm'}
+
+_priority = contextvars.ContextVar('request_priority', default=INTERACTIVE)
+
+
+class RateLimitExceeded(Exception):
+    """No token became available within the caller's wait budget."""
+
+
+@contextmanager
+def priority(level):
+    """Runs the block, and any work it submits through metrics.submit, at `level`."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+class RateLimiter:
+    """
+    Token bucket for one upstream quota, with a priority queue of waiting callers.
+
+    `per_minute` tokens refill continuously up to `burst`. Waiting callers are served
+    strictly by priority, then arrival, so interactive requests overtake queued batch
+    and prewarm work. With `db_path` the bucket lives in SQLite and is shared by every
+    gunicorn worker using that file; the queue ordering is per process.
+    A `per_minute` of 0 disables limiting.
+    """
+
+    def __init__(self, name, per_minute=0, burst=None, db_path=None):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = burst if burst is not None else max(1, per_minute // 6)
+        self.db_path = db_path
+
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters = []  # heap of (priority, sequence)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self.granted = 0
+        self.rejected = 0
+
+        if db_path and self.rate:
+            self._db().execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+            self._db().execute(
+                "INSERT OR IGNORE INTO rate_buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                (name, float(self.burst), time.time())
+            )
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3  # only shared buckets need it
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _take(self, tokens=1.0):
+        """
+        Tries to take tokens from the bucket.
+        Returns 0 on success, else the seconds until enough tokens will have refilled.
+        """
+        if self.db_path:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE name = ?", (self.name,)).fetchone()
+                now = time.time()
+                available = min(self.burst, row[0] + (now - row[1]) * self.rate)
+                granted = available >= tokens
+                if granted:
+                    available -= tokens
+                conn.execute("UPDATE rate_buckets SET tokens = ?, updated = ? WHERE name = ?", (available, now, self.name))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return 0 if granted else (tokens - available) / self.rate
+
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0
+        return (tokens - self._tokens) / self.rate
+
+    def acquire(self, timeout=None, level=None):
+        """
+        Blocks until a token is granted, in priority order.
+        Raises RateLimitExceeded if none is granted within `timeout` seconds.
+        """
+        if not self.rate:
+            return
+        level = current_priority() if level is None else level
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._condition:
+            entry = (level, next(self._sequence))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    if self._waiters[0] == entry:
+                        wait = self._take()
+                        if wait == 0:
+                            self.granted += 1
+                            return
+                    else:
+                        # Someone ahead of us is waiting for the next token
+                        wait = 1 / self.rate
+
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            raise RateLimitExceeded(f"No '{self.name}' quota available within {timeout:.1f}s")
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    def penalize(self, seconds):
+        """Empties the bucket for `seconds`, e.g. after the upstream answered 429."""
+        if not self.rate:
+            return
+        debt = -seconds * self.rate
+        with self._condition:
+            if self.db_path:
+                self._db().execute(
+                    "UPDATE rate_buckets SET tokens = MIN(tokens, ?), updated = ? WHERE name = ?",
+                    (debt, time.time(), self.name)
+                )
+            else:
+                self._tokens = min(self._tokens, debt)
+                self._updated = time.monotonic()
+        logger.warning(f"Upstream '{self.name}' is throttling, pausing its quota for {seconds:.1f}s")
+
+    def queue_depth(self):
+        """Waiting callers per priority name."""
+        with self._condition:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for level, _ in self._waiters:
+                depth[PRIORITY_NAMES.get(level, str(level))] += 1
+            return depth
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+TAXONOMY_PATH = os.getenv('TAXONOMY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taxonomy.json'))
+
+# Spelling variants that should never split a vote
+SPELLING_VARIANTS = {
+    'grey': 'gray',
+    'colour': 'color',
+    'coloured': 'colored',
+}
+
+
+def normalize_name(name):
+    """
+    Lowercases a free-text bird name and strips everything that varies between models:
+    accents, apostrophes, hyphens, punctuation, British spellings and a trailing "bird".
+    """
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(char for char in name if not unicodedata.combining(char)).lower()
+    name = re.sub(r"['’`]", '', name)
+    name = re.sub(r'[^a-z0-9]+', ' ', name)
+    words = [SPELLING_VARIANTS.get(word, word) for word in name.split()]
+    if words and words[0] == 'the':
+        words = words[1:]
+    if len(words) > 1 and words[-1] == 'bird':
+        words = words[:-1]
+    return ' '.join(words)
+
+
+class TaxonomyIndex:
+    """Maps common names, scientific names and synonyms to one canonical common name."""
+
+    def __init__(self, entries=()):
+        self._aliases = {}
+        self._scientific = {}
+        for entry in entries:
+            self.add(entry['common'], entry.get('scientific'), entry.get('synonyms', []))
+
+    @classmethod
+    def load(cls, path=TAXONOMY_PATH):
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load taxonomy from {path}: {str(e)}")
+            entries = []
+        index = cls(entries)
+        logger.info(f"Loaded {len(entries)} species into the taxonomy index")
+        return index
+
+    def add(self, common, scientific=None, synonyms=()):
+        for alias in [common, scientific, *synonyms]:
+            if not alias:
+                continue
+            key = normalize_name(alias)
+            if key in self._aliases and self._aliases[key] != common:
+                logger.debug(f"Taxonomy alias '{alias}' already maps to '{self._aliases[key]}'")
+                continue
+            self._aliases[key] = common
+        if scientific:
+            self._scientific[common] = scientific
+
+    def lookup(self, name):
+        """Returns the canonical common name for `name`, or None if it is not in the index."""
+        key = normalize_name(name)
+        if key in self._aliases:
+            return self._aliases[key]
+
+        # Models often answer "Common Name (Scientific name)" or the reverse
+        match = re.match(r'^(.*?)\s*\((.*?)\)\s*$', str(name))
+        if match:
+            for part in match.groups():
+                key = normalize_name(part)
+                if key in self._aliases:
+                    return self._aliases[key]
+        return None
+
+    def scientific_name(self, common):
+        return self._scientific.get(common)
+
+    def species_key(self, name):
+        """Stable comparison key: the canonical name when known, else the normalized text."""
+        canonical = self.lookup(name)
+        if canonical:
+            return normalize_name(canonical)
+        # Drop a parenthetical so "X (Y)" still matches a bare "X" for unknown species
+        return normalize_name(re.sub(r'\(.*?\)', ' ', str(name))) or normalize_name(name)
+
+    def tally(self, species_names):
+        """
+        Counts votes per species after normalization.
+        Returns (species, votes, total) for the species with the most votes,
+        where `species` is the canonical name or the first answer given for it.
+        """
+        names = [name for name in species_names if name]
+        if not names:
+            return None, 0, 0
+
+        counts = Counter(self.species_key(name) for name in names)
+        key, votes = counts.most_common(1)[0]
+        first_answer = next(name for name in names if self.species_key(name) == key)
+        return self.lookup(first_answer) or first_answer, votes, len(names)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Returns the process-wide taxonomy index, loading it on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = TaxonomyIndex.load()
+    return _index
+
+
+def species_key(name):
+    return get_index().species_key(name)